@@ -7,16 +7,27 @@ import uuid
 import threading
 import requests
 import os
-import boto3
 from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from zoneinfo import ZoneInfo
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from botocore.client import Config
 
 from config import Config
 from database import Database
-from yandex_client import YandexGPT, YandexStorage
+from yandex_client import YandexGPT
+from storage_client import YandexStorageClient
 from web_server import start_health_server
+from concurrency import ChatOrderedUpdateProcessor, SingleFlight, TokenBucket
+from jobs import JobWorkers
+from bucket_sync import BucketReconcile, BucketSync
+from outbox import BULK, CHANNEL, OutboxRateLimiter
+from ingest import MediaGroupCollector, TelegramFileStream, describe_media
+from images import PALETTE_SIZE, ImageProcessor, palette_names, pick_variant
+from similarity import ColorIndex, palette_similarity
+from dedup import PhashIndex, hamming, low_detail, to_signed, to_unsigned
+from channel import ChannelAutoposter, PostSchedule, parse_post_times
+from metrics import CallbackMetric, Histogram, timed
 
 # Настройка логирования
 logging.basicConfig(
@@ -39,14 +50,132 @@ def force_reset_bot():
     except Exception as e:
         logger.error(f"❌ Ошибка при сбросе: {e}")
 
-# Инициализация компонентов
-db = Database()
-storage = YandexStorage()
-gpt = YandexGPT()
+# Инициализация компонентов. Сервисы с соединениями и пулами (база, хранилище,
+# GPT, воркеры задач) создаёт init_services() из main(): процессы пула
+# изображений (spawn) заново импортируют этот модуль и не должны их повторять.
+db = None
+storage = None
+gpt = None
+job_workers = None
+bucket_sync = None
+bucket_reconcile = None
+channel_autoposter = None
+
+telegram_files = TelegramFileStream()
+image_processor = ImageProcessor(Config.IMAGE_WORKERS)
+phash_index = PhashIndex()
+color_index = ColorIndex(PALETTE_SIZE)
+album_collector = MediaGroupCollector(Config.ALBUM_COLLECT_DELAY, lambda key, items: enqueue_album(key, items))
+
+# Одна генерация на букет, сколько бы раз ни нажали кнопку
+generation_flight = SingleFlight()
+
+# Не больше одной массовой генерации одновременно
+bulk_generation_lock = asyncio.Lock()
+
+# Не больше одной синхронизации с облаком одновременно
+sync_lock = asyncio.Lock()
+
+# Все отправки бота идут через очередь с лимитами Telegram
+outbox = OutboxRateLimiter(
+    global_rate=Config.OUTBOX_GLOBAL_RATE,
+    chat_rate=Config.OUTBOX_CHAT_RATE,
+    group_rate=Config.OUTBOX_GROUP_RATE,
+    chat_burst=Config.OUTBOX_CHAT_BURST,
+    max_retries=Config.OUTBOX_MAX_RETRIES
+)
+
+# Фоновые сообщения уступают очередь ответам на действия пользователя
+BULK_SEND = {'priority': BULK}
+
+# Telegram принимает в альбоме не больше 10 фото
+MEDIA_GROUP_LIMIT = 10
 
 # Временное хранилище для состояний
 user_data = {}
 
+# Метрики для /metrics сервера здоровья. Серии обработчиков связаны заранее,
+# остальное (очереди, кэши) считается только в момент опроса.
+# bot_handler_duration_seconds - время самого обработчика апдейта. handle_photo
+# и generate_description только ставят задачу в очередь, поэтому для них это
+# время ответа "принято"; сколько пользователь ждёт результата, показывает
+# job_latency_seconds{kind="upload"|"upload_album"|"generate"} из jobs.py.
+HANDLER_SECONDS = Histogram(
+    'bot_handler_duration_seconds',
+    'Время обработчика апдейта (для фоновых задач - только постановка в очередь)', ['handler']
+)
+
+def _cache_samples():
+    records = db.cache.stats()
+    yield ('db_records',), records['hit_ratio']
+    cache = gpt.cache_stats()
+    if cache:
+        yield ('gpt',), cache['hit_ratio']
+
+def _cache_counts(field):
+    def samples():
+        yield ('db_records',), db.cache.stats()[field]
+        cache = gpt.cache_stats()
+        if cache:
+            yield ('gpt',), cache[field]
+    return samples
+
+def _job_samples():
+    for kind, counts in db.get_job_counts().items():
+        for status, count in counts.items():
+            yield (kind, status), count
+
+CallbackMetric('cache_hit_ratio', 'Доля попаданий кэша', ['cache'], _cache_samples)
+CallbackMetric('cache_hits_total', 'Попадания кэша', ['cache'], _cache_counts('hits'), kind='counter')
+CallbackMetric('cache_misses_total', 'Промахи кэша', ['cache'], _cache_counts('misses'), kind='counter')
+CallbackMetric('jobs', 'Фоновые задачи по статусам', ['kind', 'status'], _job_samples)
+CallbackMetric(
+    'outbox_queue_depth', 'Сообщения в очереди отправки', ['priority'],
+    lambda: [((name,), depth) for name, depth in outbox.stats()['depth_by_priority'].items()]
+)
+CallbackMetric('outbox_in_flight', 'Запросы к Telegram в полёте', (), lambda: [((), outbox.stats()['in_flight'])])
+CallbackMetric('outbox_sent_total', 'Отправленные запросы к Telegram', (),
+               lambda: [((), outbox.stats()['sent'])], kind='counter')
+CallbackMetric('outbox_coalesced_total', 'Схлопнутые правки сообщений', (),
+               lambda: [((), outbox.stats()['coalesced'])], kind='counter')
+CallbackMetric('outbox_retry_after_total', 'Ответы RetryAfter от Telegram', (),
+               lambda: [((), outbox.stats()['retry_after'])], kind='counter')
+
+def _outbox_wait_samples():
+    sending = outbox.stats()
+    for quantile, key in (('0.5', 'wait_p50'), ('0.95', 'wait_p95')):
+        if sending[key] is not None:
+            yield (quantile,), sending[key]
+
+CallbackMetric('outbox_wait_seconds', 'Ожидание в очереди отправки (скользящее окно)', ['quantile'],
+               _outbox_wait_samples)
+
+class StreamingStatus:
+    """Прогрессивно обновляет статусное сообщение с ограничением частоты правок"""
+    
+    def __init__(self, bot, chat_id, message_id, interval, prefix=""):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.prefix = prefix
+        self._last_edit = 0.0
+        self._shown = None
+    
+    async def update(self, text):
+        loop = asyncio.get_running_loop()
+        # Telegram ограничивает частоту правок, промежуточные чанки пропускаем
+        if text == self._shown or loop.time() - self._last_edit < self.interval:
+            return
+        self._last_edit = loop.time()
+        self._shown = text
+        try:
+            await self.bot.edit_message_text(
+                f"{self.prefix}{text} ▌", chat_id=self.chat_id, message_id=self.message_id
+            )
+        except Exception as e:
+            logger.debug(f"Не удалось обновить статус: {e}")
+
 # Проверка на администратора
 def is_admin(user_id):
     return user_id in Config.ADMIN_IDS
@@ -63,9 +192,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/help - помощь\n"
         "/list - список всех букетов\n"
         "/generate - сгенерировать описание для последнего букета\n"
+        "/generate_all - сгенерировать описания для всех букетов без описания\n"
         "/myid - показать ваш Telegram ID\n"
         "/admin - проверить права администратора\n"
-        "/sync - синхронизировать фото из облака\n\n"
+        "/sync - добавить новые фото из облака (full - проверить все)\n"
+        "/reconcile - сверить облако с базой (fix - исправить)\n"
+        "/stats - статистика кэша и очередей\n"
+        "/search <запрос> - поиск букетов по описанию\n"
+        "/reindex - оптимизировать поисковый индекс (full - перестроить)\n"
+        "/similar <id> - букеты, похожие по цвету\n"
+        "/backfill_hashes - посчитать хэши и палитры фото\n\n"
         "Просто отправь мне фото букета, и я сохраню его в облако!"
     )
     await update.message.reply_text(welcome_text)
@@ -79,9 +215,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/help - это сообщение\n"
         "/list - список всех букетов\n"
         "/generate - сгенерировать описание для последнего букета\n"
+        "/generate\\_all - сгенерировать описания для всех букетов без описания\n"
         "/myid - показать ваш Telegram ID\n"
         "/admin - проверить права администратора\n"
-        "/sync - синхронизировать фото из облака\n\n"
+        "/sync - добавить новые фото из облака (full - проверить все)\n"
+        "/reconcile - сверить облако с базой (fix - исправить)\n"
+        "/stats - статистика кэша и очередей\n"
+        "/search <запрос> - поиск букетов по описанию\n"
+        "/reindex - оптимизировать поисковый индекс (full - перестроить)\n"
+        "/similar <id> - букеты, похожие по цвету\n"
+        "/backfill\\_hashes - посчитать хэши и палитры фото\n\n"
         "📸 *Работа с фото:*\n"
         "Отправьте фото букета - оно сохранится в Яндекс.Облако\n"
         "После сохранения можно сгенерировать описание через YandexGPT"
@@ -100,142 +243,552 @@ async def show_my_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # Команда синхронизации фото из облака
+@timed(HANDLER_SECONDS.labels('sync_photos'))
 async def sync_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Синхронизирует фото из облака с базой данных"""
+    """Добавляет в базу фото из облака, появившиеся после прошлой синхронизации"""
     user_id = update.effective_user.id
     
     if not is_admin(user_id):
         await update.message.reply_text("❌ У вас нет прав")
         return
     
+    if sync_lock.locked():
+        await update.message.reply_text("⏳ Синхронизация уже идёт")
+        return
+    
+    # /sync full - пройти все объекты, не глядя на водяной знак
+    full = bool(context.args) and context.args[0] == "full"
     status_msg = await update.message.reply_text("⏳ Синхронизирую фото из облака...")
     
-    try:
-        # Подключаемся к облаку
-        s3 = boto3.client(
-            's3',
-            endpoint_url='https://storage.yandexcloud.net',
-            aws_access_key_id=Config.YC_ACCESS_KEY,
-            aws_secret_access_key=Config.YC_SECRET_KEY,
-            config=Config(signature_version='s3v4'),
-            region_name='ru-central1'
+    async def show_progress(progress):
+        if progress['stage'] == 'listing':
+            text = (
+                f"⏳ Читаю список файлов в облаке...\n\n"
+                f"📄 Страниц: {progress['pages']}\n"
+                f"🔍 Просмотрено: {progress['scanned']}\n"
+                f"🆕 Новых: {progress['new']}"
+            )
+        elif progress['stage'] == 'writing':
+            text = f"⏳ Сохраняю в базу: {progress['added']} из {progress['total_new']}"
+        else:
+            return
+        await context.bot.edit_message_text(
+            text, chat_id=status_msg.chat_id, message_id=status_msg.message_id, rate_limit_args=BULK_SEND
         )
-        
-        # Получаем список фото из папки bouquets/
-        response = s3.list_objects_v2(Bucket=Config.YC_BUCKET_NAME, Prefix='bouquets/')
-        
-        if 'Contents' not in response:
-            await status_msg.edit_text("📭 В облаке нет фото в папке bouquets/")
+    
+    async def run():
+        try:
+            async with sync_lock:
+                result = await bucket_sync.run(on_progress=show_progress, full=full)
+        except Exception as e:
+            logger.error(f"❌ Ошибка синхронизации: {e}")
+            await status_msg.edit_text(f"❌ Ошибка: {e}")
             return
         
-        count = 0
-        for obj in response['Contents']:
-            file_name = obj['Key']
-            photo_url = f"https://{Config.YC_BUCKET_NAME}.storage.yandexcloud.net/{file_name}"
-            
-            # Генерируем file_id из имени файла (убираем путь и расширение)
-            file_id = file_name.replace('bouquets/', '').replace('.jpg', '')
-            
-            # Добавляем в базу
-            success = db.add_bouquet_url(file_id, photo_url, file_name)
-            if success:
-                count += 1
-                logger.info(f"✅ Добавлено: {file_name}")
-        
         await status_msg.edit_text(
             f"✅ Синхронизация завершена!\n"
-            f"📸 Добавлено фото: {count}\n"
-            f"📊 Всего в базе: {db.get_bouquets_count()}"
+            f"🔍 Просмотрено в облаке: {result['scanned']}\n"
+            f"📸 Добавлено фото: {result['added']}\n"
+            f"🖼 Поставлено задач на уменьшенные копии: {result['variants_queued']}\n"
+            f"📊 Всего в базе: {await db.aio.get_bouquets_count()}"
+        )
+    
+    context.application.create_task(run(), update=update)
+
+# Команда сверки облака с базой
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Находит объекты без строк и строки без объектов; /reconcile fix - исправляет"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    if sync_lock.locked():
+        await update.message.reply_text("⏳ Синхронизация или сверка уже идёт")
+        return
+    
+    fix = bool(context.args) and context.args[0] == "fix"
+    status_msg = await update.message.reply_text("⏳ Сверяю облако с базой...")
+    
+    async def show_progress(progress):
+        await context.bot.edit_message_text(
+            f"⏳ Сверяю {progress['prefix']}...\n\n"
+            f"☁️ Объектов: {progress['objects']}\n"
+            f"💾 Строк: {progress['rows']}\n"
+            f"❓ Объектов без строки: {progress['missing_rows']}\n"
+            f"🕳 Строк без объекта: {progress['missing_objects']}",
+            chat_id=status_msg.chat_id, message_id=status_msg.message_id, rate_limit_args=BULK_SEND
         )
+    
+    def forget_bouquets(bouquet_ids):
+        for bouquet_id in bouquet_ids:
+            phash_index.discard(bouquet_id)
+            color_index.discard(bouquet_id)
+    
+    async def run():
+        try:
+            async with sync_lock:
+                results = await bucket_reconcile.run(
+                    fix=fix, on_progress=show_progress, on_bouquets_deleted=forget_bouquets
+                )
+        except Exception as e:
+            logger.error(f"❌ Ошибка сверки: {e}")
+            await status_msg.edit_text(f"❌ Ошибка: {e}")
+            return
         
-    except Exception as e:
-        logger.error(f"❌ Ошибка синхронизации: {e}")
-        await status_msg.edit_text(f"❌ Ошибка: {e}")
+        lines = ["✅ Сверка завершена!" if fix else "🔎 Сверка завершена (без изменений)"]
+        for result in results.values():
+            lines.append(
+                f"\n📁 {result['prefix']}\n"
+                f"☁️ Объектов: {result['objects']}, 💾 строк: {result['rows']}, совпало: {result['matched']}\n"
+                f"❓ Объектов без строки: {result['missing_rows']}\n"
+                f"🕳 Строк без объекта: {result['missing_objects']}"
+            )
+            if result['skipped_recent']:
+                lines.append(f"⏱ Свежих, пропущено: {result['skipped_recent']}")
+            if fix:
+                lines.append(
+                    f"➕ Импортировано: {result['imported']}, 🗑 удалено объектов: {result['deleted_objects']}, "
+                    f"строк: {result['deleted_rows']}"
+                )
+                if result.get('variants_queued'):
+                    lines.append(f"🖼 Задач на уменьшенные копии: {result['variants_queued']}")
+            else:
+                lines.extend(f"  • {key}" for key in result['samples_missing_rows'] + result['samples_missing_objects'])
+        if not fix:
+            lines.append("\nЧтобы исправить: /reconcile fix")
+        await status_msg.edit_text("\n".join(lines))
+    
+    context.application.create_task(run(), update=update)
 
 # Обработчик фото
+@timed(HANDLER_SECONDS.labels('handle_photo'))
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик получения фото"""
+    """Обработчик получения фото: ставит загрузку в очередь и сразу отвечает"""
     user_id = update.effective_user.id
     
     if not is_admin(user_id):
         await update.message.reply_text("❌ У вас нет прав для загрузки фото")
         return
     
+    media, preview, content_type, extension = describe_media(update.message)
+    item = {
+        'file_id': media.file_id,
+        'file_unique_id': media.file_unique_id,
+        'preview_file_id': preview.file_id if preview else None,
+        'content_type': content_type,
+        'extension': extension
+    }
+    
+    # Фото альбома собираются в одну пачку и загружаются одной задачей
+    if update.message.media_group_id:
+        album_collector.add(
+            (update.effective_chat.id, update.message.media_group_id),
+            dict(item, user_id=user_id, bot=context.bot)
+        )
+        return
+    
+    status_msg = await update.message.reply_text("⏳ Фото принято, сохраняю в облако...")
+    await enqueue_or_report(context.bot, 'upload', dict(
+        item,
+        user_id=user_id,
+        chat_id=status_msg.chat_id,
+        message_id=status_msg.message_id
+    ))
+
+async def _preview_features(bot, item):
+    """(перцептивный хэш, палитра) по маленькому превью из Telegram или (None, None)"""
+    if not item.get('preview_file_id'):
+        return None, None
     try:
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        file_unique_id = photo.file_unique_id
-        
-        status_msg = await update.message.reply_text("⏳ Сохраняю фото в облако...")
-        
-        file = await context.bot.get_file(file_id)
-        file_bytes = await file.download_as_bytearray()
-        
-        file_name = f"bouquets/{file_unique_id}.jpg"
-        photo_url = storage.upload_file(bytes(file_bytes), file_name)
-        
-        if photo_url:
-            bouquet_id = db.add_bouquet(file_id, photo_url, file_name)
-            
-            if bouquet_id:
-                user_data[user_id] = {'last_bouquet_id': bouquet_id}
-                
-                keyboard = [
-                    [InlineKeyboardButton("✨ Сгенерировать описание", callback_data=f"generate_{bouquet_id}")],
-                    [InlineKeyboardButton("📋 Список всех букетов", callback_data="list")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await status_msg.edit_text(
-                    f"✅ Фото успешно сохранено!\n\n"
-                    f"📸 ID букета: {bouquet_id}\n"
-                    f"🔗 Ссылка: {photo_url}",
-                    reply_markup=reply_markup
-                )
-            else:
-                await status_msg.edit_text("❌ Ошибка при сохранении в базу данных")
-        else:
-            await status_msg.edit_text("❌ Ошибка при загрузке в облако")
-            
+        preview = await bot.get_file(item['preview_file_id'])
+        phash, palette = await image_processor.analyze(await telegram_files.download(preview))
+        return to_signed(phash), palette
     except Exception as e:
-        logger.error(f"Ошибка обработки фото: {e}")
-        await update.message.reply_text(f"❌ Ошибка: {e}")
+        logger.warning(f"⚠️ Не удалось обработать превью: {e}")
+        return None, None
 
-# Команда /list
-async def list_bouquets(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает список всех букетов"""
-    user_id = update.effective_user.id
+def _index_features(bouquet_id, phash, palette):
+    """Добавляет признаки нового букета в индексы дубликатов и цветов"""
+    if phash is not None:
+        phash_index.add(phash, bouquet_id)
+    if palette is not None:
+        color_index.add(bouquet_id, palette)
+
+def _find_duplicate(phash, palette):
+    """Ближайший существующий букет в пределах DUPLICATE_MAX_DISTANCE: (расстояние, id) или None"""
+    if phash is None:
+        return None
+    matches = phash_index.query(phash, Config.DUPLICATE_MAX_DISTANCE)
+    if matches and low_detail(phash, Config.DUPLICATE_MIN_HASH_BITS):
+        # Почти пустой хэш совпадает у любых однотонных фото - подтверждаем палитрой
+        if palette is None:
+            return None
+        matches = [
+            (distance, bouquet_id) for distance, bouquet_id in matches
+            if (color_index.similarity(palette, bouquet_id) or 0.0) >= Config.DUPLICATE_MIN_COLOR_SCORE
+        ]
+    return matches[0] if matches else None
+
+def _same_photo(phash, palette, other_phash, other_palette):
+    """Почти-дубликат внутри одной пачки: те же правила, что у _find_duplicate"""
+    if phash is None or other_phash is None:
+        return False
+    if hamming(to_unsigned(phash), to_unsigned(other_phash)) > Config.DUPLICATE_MAX_DISTANCE:
+        return False
+    if not low_detail(phash, Config.DUPLICATE_MIN_HASH_BITS):
+        return True
+    return (
+        palette is not None and other_palette is not None
+        and palette_similarity(palette, other_palette) >= Config.DUPLICATE_MIN_COLOR_SCORE
+    )
+
+async def _upload_media(bot, item):
+    """Потоково переносит файл из Telegram в бакет, возвращает (url, имя файла)"""
+    file = await bot.get_file(item['file_id'])
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ У вас нет прав")
-        return
+    # Поток из Telegram сразу уходит в бакет, без полной копии в памяти
+    file_name = f"bouquets/{item['file_unique_id']}.{item.get('extension', 'jpg')}"
+    photo_url = await storage.upload_stream(
+        telegram_files.iter_chunks(file),
+        file_name,
+        content_type=item.get('content_type', 'image/jpeg'),
+        size=file.file_size
+    )
+    return photo_url, file_name
+
+async def edit_status(bot, payload, text, **kwargs):
+    """Правит статусное сообщение задачи; ошибка правки не повод повторять задачу.
     
-    bouquets = db.get_all_bouquets()
+    К этому моменту результат уже сохранён, а повтор задачи снова вызвал бы
+    GPT или нашёл бы в дубликатах только что сохранённый букет. Если Telegram
+    не принял Markdown (например, в тексте GPT), текст отправляется без разметки.
+    """
+    try:
+        await bot.edit_message_text(text, chat_id=payload['chat_id'], message_id=payload['message_id'], **kwargs)
+    except BadRequest as e:
+        if kwargs.pop('parse_mode', None) is None:
+            logger.warning(f"⚠️ Не удалось обновить статусное сообщение: {e}")
+            return
+        await edit_status(bot, payload, text, **kwargs)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось обновить статусное сообщение: {e}")
+
+async def report_upload(bot, payload, bouquet_id, photo_url):
+    keyboard = [
+        [InlineKeyboardButton("✨ Сгенерировать описание", callback_data=f"generate_{bouquet_id}")],
+        [InlineKeyboardButton("📋 Список всех букетов", callback_data="list")]
+    ]
+    await edit_status(
+        bot, payload,
+        f"✅ Фото успешно сохранено!\n\n"
+        f"📸 ID букета: {bouquet_id}\n"
+        f"🔗 Ссылка: {photo_url}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# Фоновая загрузка фото в облако
+async def process_upload_job(bot, job):
+    """Проверяет фото на дубликат, загружает в облако и сохраняет в базу"""
+    payload = job.payload
     
-    if not bouquets:
-        await update.message.reply_text("📭 В базе пока нет букетов")
+    # Повтор задачи после сбоя уже сохранённого фото: не ищем дубликат
+    # (нашёлся бы сам букет) и не загружаем заново, только сообщаем результат
+    saved = await db.aio.get_bouquet_ids_by_file_ids([payload['file_id']])
+    if payload['file_id'] in saved:
+        bouquet = await db.aio.get_bouquet(saved[payload['file_id']])
+        if bouquet:
+            user_data[payload['user_id']] = {'last_bouquet_id': bouquet.id}
+            await report_upload(bot, payload, bouquet.id, bouquet.photo_url)
+            return
+    
+    # Почти-дубликат отсекаем до загрузки в облако и генерации
+    phash, palette = await _preview_features(bot, payload)
+    duplicate = None if payload.get('force') else _find_duplicate(phash, palette)
+    if duplicate:
+        distance, duplicate_id = duplicate
+        keyboard = [[InlineKeyboardButton("📤 Всё равно сохранить", callback_data=f"force_{job.id}")]]
+        await edit_status(
+            bot, payload,
+            f"⚠️ Похоже, этот букет уже есть: #{duplicate_id} "
+            f"(отличие {distance} из 64 бит).\n\n"
+            f"Фото не загружено.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
         return
     
-    await update.message.reply_text(f"📊 Всего букетов: {len(bouquets)}")
+    photo_url, file_name = await _upload_media(bot, payload)
+    if not photo_url:
+        raise RuntimeError("Ошибка при загрузке в облако")
+    
+    bouquet_id = await db.aio.add_bouquet(payload['file_id'], photo_url, file_name, phash=phash, palette=palette)
+    if not bouquet_id:
+        raise RuntimeError("Ошибка при сохранении в базу данных")
+    _index_features(bouquet_id, phash, palette)
+    
+    user_data[payload['user_id']] = {'last_bouquet_id': bouquet_id}
+    await job_workers.enqueue('variants', {'bouquet_id': bouquet_id})
+    await report_upload(bot, payload, bouquet_id, photo_url)
+
+# Альбом собран - одно статусное сообщение и одна задача на все фото
+async def enqueue_album(key, items):
+    chat_id, _ = key
+    bot = items[0]['bot']
+    status_msg = await bot.send_message(chat_id, f"⏳ Альбом принят: {len(items)} фото, сохраняю в облако...")
+    await enqueue_or_report(bot, 'upload_album', {
+        'user_id': items[0]['user_id'],
+        'chat_id': chat_id,
+        'message_id': status_msg.message_id,
+        'items': [{k: v for k, v in item.items() if k not in ('bot', 'user_id')} for item in items]
+    })
+
+# Фоновая загрузка альбома
+async def process_album_job(bot, job):
+    """Параллельно загружает фото альбома и сохраняет их одной транзакцией"""
+    payload = job.payload
+    items = payload['items']
+    
+    # Фото, сохранённые прошлой попыткой задачи, не проверяем и не загружаем снова
+    saved = await db.aio.get_bouquet_ids_by_file_ids([item['file_id'] for item in items])
+    
+    # Хэши превью считаем сразу для всех фото, дубликаты не загружаем
+    fresh = [(index, item) for index, item in enumerate(items) if item['file_id'] not in saved]
+    features = await asyncio.gather(*(_preview_features(bot, item) for _, item in fresh))
+    accepted, duplicates, skipped = [], [], []
+    for (index, item), (phash, palette) in zip(fresh, features):
+        if not payload.get('force'):
+            duplicate = _find_duplicate(phash, palette)
+            if duplicate is None and any(
+                _same_photo(phash, palette, other, other_palette) for _, other, other_palette in accepted
+            ):
+                duplicate = (0, None)
+            if duplicate:
+                duplicates.append(duplicate[1])
+                skipped.append(index)
+                continue
+        accepted.append((item, phash, palette))
+    
+    results = await asyncio.gather(
+        *(_upload_media(bot, item) for item, _, _ in accepted), return_exceptions=True
+    )
+    rows = []
+    for (item, phash, palette), result in zip(accepted, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Ошибка загрузки фото альбома: {result}")
+            continue
+        photo_url, file_name = result
+        if photo_url:
+            rows.append((item['file_id'], photo_url, file_name, phash, palette))
+    if not rows and not duplicates and not saved:
+        raise RuntimeError("Ни одно фото альбома не загружено")
+    
+    ids = await db.aio.add_bouquets_batch(rows) if rows else {}
+    if rows and not ids:
+        raise RuntimeError("Ошибка при сохранении в базу данных")
+    
+    new_ids = []
+    for file_id, _, _, phash, palette in rows:
+        if file_id in ids and file_id not in saved:
+            new_ids.append(ids[file_id])
+            _index_features(ids[file_id], phash, palette)
+    bouquet_ids = [
+        saved.get(item['file_id']) or ids[item['file_id']]
+        for item in items if item['file_id'] in saved or item['file_id'] in ids
+    ]
+    if bouquet_ids:
+        user_data[payload['user_id']] = {'last_bouquet_id': bouquet_ids[-1]}
+    for bouquet_id in new_ids:
+        await job_workers.enqueue('variants', {'bouquet_id': bouquet_id})
+    
+    failed = len(items) - len(bouquet_ids) - len(duplicates)
+    text = f"✅ Альбом сохранён!\n\n📸 Сохранено фото: {len(bouquet_ids)}\n"
+    if failed:
+        text += f"❌ Не удалось: {failed}\n"
+    if bouquet_ids:
+        text += f"🌸 Букеты: {', '.join(f'#{bouquet_id}' for bouquet_id in bouquet_ids)}\n"
+    keyboard = [[InlineKeyboardButton("📋 Список всех букетов", callback_data="list")]]
+    if duplicates:
+        similar = sorted({f"#{bouquet_id}" for bouquet_id in duplicates if bouquet_id})
+        text += f"⚠️ Пропущены похожие на существующие: {len(duplicates)}"
+        text += f" ({', '.join(similar)})" if similar else ""
+        keyboard.insert(0, [InlineKeyboardButton("📤 Сохранить всё равно", callback_data=f"force_{job.id}")])
+    
+    await edit_status(bot, payload, text, reply_markup=InlineKeyboardMarkup(keyboard))
+    # Кнопка «Сохранить всё равно» догружает только пропущенные фото
+    return {'skipped': skipped}
+
+# Фоновая подготовка вариантов изображения
+async def process_variants_job(bot, job):
+    """Строит уменьшенные варианты фото в пуле процессов и загружает их в бакет"""
+    bouquet = await db.aio.get_bouquet(job.payload['bouquet_id'])
+    if bouquet:
+        await build_bouquet_variants(bouquet)
+
+async def build_bouquet_variants(bouquet):
+    """Скачивает оригинал, строит варианты и сохраняет их в бакет и базу"""
+    bouquet_id = bouquet.id
+    data = await storage.download_file(bouquet.file_name)
+    if data is None:
+        raise RuntimeError(f"Не удалось скачать оригинал {bouquet.file_name}")
+    variants = await image_processor.build_variants(data)
+    
+    # Для фото без превью (документы, синхронизация) признаки считаем по оригиналу
+    if bouquet.phash is None or bouquet.palette is None:
+        phash, palette = await image_processor.analyze(data)
+        phash = to_signed(phash)
+        await db.aio.set_image_features(bouquet_id, phash, palette)
+        _index_features(bouquet_id, phash, palette)
+    
+    stem = os.path.splitext(os.path.basename(bouquet.file_name))[0]
+    for variant in variants:
+        variant['file_name'] = f"variants/{stem}/{variant['variant']}.{variant['extension']}"
+        variant['size'] = len(variant['body'])
+    urls = await asyncio.gather(*(
+        storage.upload_file(v['body'], v['file_name'], content_type=v['content_type']) for v in variants
+    ))
+    if not all(urls):
+        raise RuntimeError("Не все варианты загружены в облако")
+    for variant, url in zip(variants, urls):
+        variant['photo_url'] = url
+    
+    await db.aio.save_variants(bouquet_id, variants)
+    logger.info(f"✅ Варианты букета #{bouquet_id}: {', '.join(v['variant'] for v in variants)}")
+
+def card_photo(bouquet, variants, use_cache=True, min_side=Config.CARD_PHOTO_SIDE):
+    """Фото для карточки: (file_id или ссылка, имя варианта или None для оригинала, из кэша ли).
     
-    for bouquet in bouquets[:5]:
+    Берётся самый лёгкий вариант, достаточный для карточки в списке (или
+    для поста в канале - min_side=POST_PHOTO_SIDE). Если Telegram уже видел
+    это фото, отправляем его file_id и не качаем из бакета.
+    """
+    variant = pick_variant(variants.get(bouquet.id, []), min_side)
+    source = variant if variant else bouquet
+    name = variant.variant if variant else None
+    if use_cache and source.tg_file_id:
+        return source.tg_file_id, name, True
+    return source.photo_url, name, False
+
+def card_caption(bouquet, extra_captions=None):
+    """Подпись карточки букета (Markdown)"""
+    caption = f"🌸 *Букет #{bouquet.id}*\n"
+    if extra_captions and bouquet.id in extra_captions:
+        caption += extra_captions[bouquet.id]
+    if bouquet.description:
+        caption += f"\n📝 {bouquet.description[:100]}..."
+    else:
+        caption += "\n❌ Описание отсутствует"
+    return caption
+
+async def _send_cards(message, cards):
+    """Отправляет карточки (bouquet, фото, вариант, из кэша, подпись); возвращает отправленные сообщения"""
+    if len(cards) == 1:
+        bouquet, photo, _, _, caption = cards[0]
         keyboard = [
-            [InlineKeyboardButton("✨ Сгенерировать описание", callback_data=f"generate_{bouquet['id']}")]
+            [InlineKeyboardButton("✨ Сгенерировать описание", callback_data=f"generate_{bouquet.id}")]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        caption = f"🌸 *Букет #{bouquet['id']}*\n"
-        if bouquet['description']:
-            caption += f"\n📝 {bouquet['description'][:100]}..."
-        else:
-            caption += "\n❌ Описание отсутствует"
-        
-        await update.message.reply_photo(
-            photo=bouquet['photo_url'],
+        sent = await message.reply_photo(
+            photo=photo,
             caption=caption,
-            reply_markup=reply_markup,
+            reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='Markdown'
         )
+        return [sent]
+    
+    return await message.reply_media_group(
+        media=[
+            InputMediaPhoto(media=photo, caption=caption, parse_mode='Markdown')
+            for _, photo, _, _, caption in cards
+        ]
+    )
+
+async def send_bouquet_cards(message, bouquets, extra_captions=None):
+    """Отправляет карточки букетов альбомами по 10 фото.
+    
+    У альбома не может быть кнопок, поэтому кнопки генерации описания
+    приходят следующим сообщением. file_id, которые вернул Telegram,
+    сохраняются и используются при следующих отправках.
+    """
+    variants = await db.aio.get_variants(bouquet.id for bouquet in bouquets)
+    cards = [
+        (bouquet, *card_photo(bouquet, variants), card_caption(bouquet, extra_captions))
+        for bouquet in bouquets
+    ]
+    
+    for start in range(0, len(cards), MEDIA_GROUP_LIMIT):
+        chunk = cards[start:start + MEDIA_GROUP_LIMIT]
+        try:
+            sent = await _send_cards(message, chunk)
+        except BadRequest as e:
+            cached = [card for card in chunk if card[3]]
+            if not cached:
+                raise
+            # Сохранённый file_id больше не принимается - сбрасываем и шлём по ссылкам
+            logger.warning(f"⚠️ Telegram отверг сохранённые file_id: {e}")
+            await db.aio.set_tg_file_ids((bouquet.id, variant, None) for bouquet, _, variant, _, _ in cached)
+            chunk = [
+                (bouquet, *card_photo(bouquet, variants, use_cache=False), caption)
+                for bouquet, *_, caption in chunk
+            ]
+            sent = await _send_cards(message, chunk)
+        
+        await db.aio.set_tg_file_ids(
+            (bouquet.id, variant, reply.photo[-1].file_id)
+            for (bouquet, _, variant, is_cached, _), reply in zip(chunk, sent)
+            if not is_cached and reply.photo
+        )
+        
+        if len(chunk) > 1:
+            keyboard = [
+                [InlineKeyboardButton(f"✨ Описание для #{bouquet.id}", callback_data=f"generate_{bouquet.id}")]
+                for bouquet, *_ in chunk
+            ]
+            await message.reply_text("Сгенерировать описание:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def send_catalog_page(message, page=1, cursor=None, backward=False):
+    """Отправляет страницу каталога и сообщение с кнопками ◀️ / ▶️.
+    
+    В кнопках лежит курсор (unix-время, id) крайнего букета страницы,
+    поэтому соседняя страница выбирается по индексу без OFFSET.
+    """
+    bouquets, has_more = await db.aio.get_bouquets_page(Config.LIST_PAGE_SIZE, cursor, backward)
+    if not bouquets:
+        await message.reply_text("📭 В базе пока нет букетов")
+        return
+    
+    if backward:
+        has_prev, has_next = has_more, True
+        if not has_prev:
+            page = 1
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    
+    await send_bouquet_cards(message, bouquets)
+    
+    total = await db.aio.get_bouquets_count()
+    pages = max(1, -(-total // Config.LIST_PAGE_SIZE))
+    buttons = []
+    if has_prev:
+        created, bouquet_id = bouquets[0].created_ts, bouquets[0].id
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"page_p_{page - 1}_{created}_{bouquet_id}"))
+    if has_next:
+        created, bouquet_id = bouquets[-1].created_ts, bouquets[-1].id
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"page_n_{page + 1}_{created}_{bouquet_id}"))
+    
+    await message.reply_text(
+        f"📊 Всего букетов: {total}\n📄 Страница {min(page, pages)} из {pages}",
+        reply_markup=InlineKeyboardMarkup([buttons]) if buttons else None
+    )
+
+# Команда /list
+@timed(HANDLER_SECONDS.labels('list_bouquets'))
+async def list_bouquets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает каталог букетов постранично"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    await send_catalog_page(update.message)
 
 # Команда /generate
 async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -253,40 +806,426 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bouquet_id = user_data[user_id]['last_bouquet_id']
     await generate_description(update, context, bouquet_id)
 
+def build_prompt(bouquet):
+    """Промпт для генерации описания букета"""
+    prompt = f"Составь красивое описание для букета цветов. Название букета: {bouquet.name}. Опиши цветы, их значение, кому подойдет такой букет."
+    # Палитра фото делает описание конкретнее
+    colors = palette_names(bouquet.palette) if bouquet.palette else []
+    if colors:
+        prompt += f" Основные цвета букета на фото: {', '.join(colors)}."
+    return prompt
+
+# Генерация с сохранением результата; одна на букет благодаря generation_flight
+async def _generate_and_save(bouquet, on_progress=None, use_cache=True):
+    """Запрашивает описание у YandexGPT и сохраняет его в базу"""
+    prompt = build_prompt(bouquet)
+    if Config.GPT_STREAMING:
+        description = await gpt.agenerate_streaming(prompt, on_progress=on_progress, use_cache=use_cache)
+    else:
+        description = await gpt.agenerate_description(prompt, use_cache=use_cache)
+    
+    if description:
+        # Описание и запись в истории - одной транзакцией
+        await db.aio.save_generations_batch([(bouquet.id, prompt, description)])
+    return description
+
 # Функция генерации описания
-async def generate_description(update: Update, context: ContextTypes.DEFAULT_TYPE, bouquet_id):
-    """Генерирует описание для указанного букета"""
-    user_id = update.effective_user.id
+@timed(HANDLER_SECONDS.labels('generate_description'))
+async def generate_description(update: Update, context: ContextTypes.DEFAULT_TYPE, bouquet_id, use_cache=True):
+    """Ставит генерацию описания для указанного букета в очередь.
+    
+    use_cache=False ("Сгенерировать снова") всегда запрашивает новый текст.
+    """
+    message = update.effective_message
+    
+    bouquet = await db.aio.get_bouquet(bouquet_id)
+    if not bouquet:
+        await message.reply_text("❌ Букет не найден")
+        return
+    
+    if generation_flight.in_flight(bouquet_id):
+        status_msg = await message.reply_text(
+            f"⏳ Описание для букета #{bouquet_id} уже генерируется, жду результат..."
+        )
+    else:
+        status_msg = await message.reply_text("⏳ Генерирую описание через YandexGPT...")
+    
+    await enqueue_or_report(context.bot, 'generate', {
+        'bouquet_id': bouquet_id,
+        'chat_id': status_msg.chat_id,
+        'message_id': status_msg.message_id,
+        'use_cache': use_cache
+    })
+
+# Фоновая генерация описания
+async def process_generate_job(bot, job):
+    """Генерирует описание и показывает результат в статусном сообщении"""
+    payload = job.payload
+    bouquet_id = payload['bouquet_id']
     
-    bouquet = db.get_bouquet(bouquet_id)
+    bouquet = await db.aio.get_bouquet(bouquet_id)
     if not bouquet:
-        await update.message.reply_text("❌ Букет не найден")
+        await edit_status(bot, payload, "❌ Букет не найден")
         return
     
-    status_msg = await update.message.reply_text("⏳ Генерирую описание через YandexGPT...")
+    # Повторные нажатия и другие чаты присоединяются к уже идущей генерации
+    progress = StreamingStatus(
+        bot, payload['chat_id'], payload['message_id'], Config.STREAM_EDIT_INTERVAL, prefix="✍️ "
+    )
+    description, _ = await generation_flight.do(
+        bouquet_id,
+        lambda: _generate_and_save(bouquet, on_progress=progress.update, use_cache=payload['use_cache'])
+    )
+    if not description:
+        raise RuntimeError("Ошибка генерации описания")
     
-    prompt = f"Составь красивое описание для букета цветов. Название букета: {bouquet['name']}. Опиши цветы, их значение, кому подойдет такой букет."
-    description = gpt.generate_description(prompt)
+    keyboard = [
+        [InlineKeyboardButton("📋 Список букетов", callback_data="list")],
+        [InlineKeyboardButton("🔄 Сгенерировать снова", callback_data=f"regenerate_{bouquet_id}")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
     
-    if description:
-        db.update_description(bouquet_id, description)
-        db.add_generation(bouquet_id, prompt, description)
+    # Описание уже в базе: ошибка правки не должна запускать генерацию заново
+    await edit_status(
+        bot, payload,
+        f"✅ *Описание сгенерировано!*\n\n"
+        f"📝 {description}\n\n"
+        f"🌸 Букет #{bouquet_id}",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+# Тексты ошибок фоновых задач для статусного сообщения
+JOB_ERROR_TEXTS = {
+    'upload': "❌ Ошибка при загрузке фото",
+    'upload_album': "❌ Ошибка при загрузке альбома",
+    'generate': "❌ Ошибка генерации описания"
+}
+
+async def enqueue_or_report(bot, kind, payload):
+    """Ставит задачу в очередь; если база её не приняла, пишет об этом в статусное сообщение"""
+    try:
+        job_id = await job_workers.enqueue(kind, payload)
+    except Exception as e:
+        logger.error(f"❌ Не удалось поставить задачу {kind}: {e}")
+        job_id = None
+    if job_id is None:
+        await bot.edit_message_text(
+            f"{JOB_ERROR_TEXTS.get(kind, '❌ Ошибка')}: не удалось поставить задачу в очередь, попробуйте ещё раз",
+            chat_id=payload['chat_id'],
+            message_id=payload['message_id']
+        )
+    return job_id
+
+# Сообщение об окончательной ошибке фоновой задачи
+async def notify_job_failure(bot, job, error):
+    payload = job.payload
+    await bot.edit_message_text(
+        f"{JOB_ERROR_TEXTS.get(job.kind, '❌ Ошибка')}: {error}",
+        chat_id=payload['chat_id'],
+        message_id=payload['message_id']
+    )
+
+# Автопостинг в канал
+CHANNEL_SEND = {'priority': CHANNEL}
+CAPTION_LIMIT = 1024
+
+def channel_caption(bouquet):
+    """Подпись поста в канале (без разметки: описание от GPT может её сломать)"""
+    parts = [f"🌸 {bouquet.name}"] if bouquet.name else []
+    if bouquet.description:
+        parts.append(bouquet.description if parts else f"🌸 {bouquet.description}")
+    caption = "\n\n".join(parts) or "🌸"
+    if len(caption) > CAPTION_LIMIT:
+        caption = caption[:CAPTION_LIMIT - 1] + "…"
+    return caption
+
+async def prepare_channel_post(bot, bouquet):
+    """Готовит пост заранее: описание, вариант фото для поста и его file_id в Telegram"""
+    if not bouquet.description:
+        description, _ = await generation_flight.do(bouquet.id, lambda: _generate_and_save(bouquet))
+        if not description:
+            raise RuntimeError("Не удалось сгенерировать описание")
+    
+    variants = await db.aio.get_variants([bouquet.id])
+    if not variants.get(bouquet.id):
+        await build_bouquet_variants(bouquet)
+        variants = await db.aio.get_variants([bouquet.id])
+    
+    photo, variant, cached = card_photo(bouquet, variants, min_side=Config.POST_PHOTO_SIDE)
+    if cached or not Config.CHANNEL_PREFETCH_CHAT:
+        return
+    # Telegram скачивает фото по ссылке один раз - здесь, а в слот уходит только file_id
+    sent = await bot.send_photo(
+        Config.CHANNEL_PREFETCH_CHAT, photo, disable_notification=True, rate_limit_args=BULK_SEND
+    )
+    await db.aio.set_tg_file_ids([(bouquet.id, variant, sent.photo[-1].file_id)])
+    try:
+        await sent.delete()
+    except Exception as e:
+        logger.debug(f"Не удалось удалить служебное фото: {e}")
+
+async def publish_channel_post(bot, bouquet):
+    """Публикует букет в канал одной отправкой; возвращает message_id"""
+    variants = await db.aio.get_variants([bouquet.id])
+    photo, variant, cached = card_photo(bouquet, variants, min_side=Config.POST_PHOTO_SIDE)
+    try:
+        sent = await bot.send_photo(
+            Config.CHANNEL_ID, photo, caption=channel_caption(bouquet), rate_limit_args=CHANNEL_SEND
+        )
+    except BadRequest as e:
+        if not cached:
+            raise
+        logger.warning(f"⚠️ Telegram отверг сохранённый file_id: {e}")
+        await db.aio.set_tg_file_ids([(bouquet.id, variant, None)])
+        photo, variant, cached = card_photo(bouquet, variants, use_cache=False, min_side=Config.POST_PHOTO_SIDE)
+        sent = await bot.send_photo(
+            Config.CHANNEL_ID, photo, caption=channel_caption(bouquet), rate_limit_args=CHANNEL_SEND
+        )
+    if not cached and sent.photo:
+        await db.aio.set_tg_file_ids([(bouquet.id, variant, sent.photo[-1].file_id)])
+    return sent.message_id
+
+def _build_channel_autoposter():
+    post_times = parse_post_times(Config.CHANNEL_POST_TIMES)
+    if not Config.CHANNEL_ID or not post_times:
+        return None
+    return ChannelAutoposter(
+        db,
+        PostSchedule(post_times, ZoneInfo(Config.CHANNEL_TIMEZONE)),
+        prepare=prepare_channel_post,
+        publish=publish_channel_post,
+        prefetch_seconds=Config.CHANNEL_PREFETCH_MINUTES * 60,
+        catchup_seconds=Config.CHANNEL_CATCHUP_MINUTES * 60
+    )
+
+# Массовая генерация описаний
+async def _run_bulk_generation(status_msg, bouquets):
+    """Генерирует описания пулом воркеров с ограничением частоты запросов"""
+    queue = asyncio.Queue()
+    for bouquet in bouquets:
+        queue.put_nowait(bouquet)
+    
+    bucket = TokenBucket(Config.BULK_GPT_RPS)
+    total = len(bouquets)
+    counters = {'done': 0, 'failed': 0}
+    batch = []
+    started = asyncio.get_running_loop().time()
+    
+    async def flush():
+        # Пачку забираем до await: воркеры продолжают пополнять batch
+        items = batch[:]
+        batch.clear()
+        if items and not await db.aio.save_generations_batch(items):
+            counters['failed'] += len(items)
+            counters['done'] -= len(items)
+    
+    def progress_text(title):
+        elapsed = max(asyncio.get_running_loop().time() - started, 1e-6)
+        processed = counters['done'] + counters['failed']
+        return (
+            f"{title}\n\n"
+            f"✅ Готово: {counters['done']}\n"
+            f"❌ Ошибок: {counters['failed']}\n"
+            f"⏳ Осталось: {total - processed}\n"
+            f"⚡ Скорость: {processed / elapsed * 60:.1f} шт/мин"
+        )
+    
+    async def worker():
+        while True:
+            try:
+                bouquet = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await bucket.acquire()
+            prompt = build_prompt(bouquet)
+            # Уникальные описания важнее кэша: промпты у букетов совпадают
+            description, shared = await generation_flight.do(
+                bouquet.id, lambda: gpt.agenerate_description(prompt, use_cache=False)
+            )
+            if not description:
+                counters['failed'] += 1
+                continue
+            counters['done'] += 1
+            # Совместную генерацию уже сохранил интерактивный обработчик
+            if not shared:
+                batch.append((bouquet.id, prompt, description))
+                if len(batch) >= Config.BULK_BATCH_SIZE:
+                    await flush()
+    
+    async def reporter():
+        while True:
+            await asyncio.sleep(Config.BULK_PROGRESS_INTERVAL)
+            try:
+                await status_msg.get_bot().edit_message_text(
+                    progress_text("⏳ Генерирую описания..."),
+                    chat_id=status_msg.chat_id,
+                    message_id=status_msg.message_id,
+                    rate_limit_args=BULK_SEND
+                )
+            except Exception as e:
+                logger.debug(f"Не удалось обновить прогресс: {e}")
+    
+    report_task = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(Config.BULK_WORKERS, total))))
+    finally:
+        report_task.cancel()
+        await flush()
+    
+    await status_msg.edit_text(progress_text("✅ Массовая генерация завершена!"))
+
+# Команда /generate_all
+async def generate_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Генерирует описания для всех букетов без описания"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    if bulk_generation_lock.locked():
+        await update.message.reply_text("⏳ Массовая генерация уже идёт")
+        return
+    
+    bouquets = await db.aio.get_bouquets_without_description()
+    if not bouquets:
+        await update.message.reply_text("✅ У всех букетов уже есть описание")
+        return
+    
+    status_msg = await update.message.reply_text(
+        f"⏳ Генерирую описания для {len(bouquets)} букетов..."
+    )
+    
+    async def run():
+        async with bulk_generation_lock:
+            await _run_bulk_generation(status_msg, bouquets)
+    
+    # Работа идёт в фоне, чат остаётся отзывчивым
+    context.application.create_task(run(), update=update)
+
+# Команда /search
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ищет букеты по названию, описанию и истории генераций"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("ℹ️ Использование: /search <слова из названия или описания>")
+        return
+    
+    hits = await db.aio.search_bouquets(query, limit=Config.SEARCH_LIMIT)
+    if not hits:
+        await update.message.reply_text(f"🔎 По запросу «{query}» ничего не найдено")
+        return
+    
+    bouquets = await db.aio.get_bouquets_by_ids(hit.bouquet_id for hit in hits)
+    snippets = {
+        hit.bouquet_id: f"🔎 {'из истории: ' if hit.source == 'generation' else ''}{hit.snippet}\n"
+        for hit in hits
+    }
+    await update.message.reply_text(f"🔎 Найдено по запросу «{query}»: {len(bouquets)}")
+    await send_bouquet_cards(update.message, bouquets, extra_captions=snippets)
+
+# Команда /reindex
+async def reindex_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обслуживает поисковый индекс: optimize по умолчанию, /reindex full - полная перестройка"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    rebuild = bool(context.args) and context.args[0] == "full"
+    status_msg = await update.message.reply_text(
+        "⏳ Перестраиваю поисковый индекс..." if rebuild else "⏳ Оптимизирую поисковый индекс..."
+    )
+    if await db.aio.optimize_search_index(rebuild=rebuild):
+        await status_msg.edit_text("✅ Поисковый индекс перестроен" if rebuild else "✅ Поисковый индекс оптимизирован")
+    else:
+        await status_msg.edit_text("❌ Не удалось обслужить поисковый индекс")
+
+# Команда /similar
+async def similar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает букеты, похожие по цвету на указанный"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    if not context.args or not context.args[0].lstrip('#').isdigit():
+        await update.message.reply_text("ℹ️ Использование: /similar <id букета>")
+        return
+    
+    bouquet_id = int(context.args[0].lstrip('#'))
+    if bouquet_id not in color_index:
+        await update.message.reply_text(
+            f"📭 Нет данных о цветах букета #{bouquet_id} (попробуйте /backfill_hashes)"
+        )
+        return
+    matches = color_index.similar(bouquet_id, limit=Config.SIMILAR_LIMIT, min_score=Config.SIMILAR_MIN_SCORE)
+    if not matches:
+        await update.message.reply_text(f"🤷 Букетов, похожих по цвету на #{bouquet_id}, не нашлось")
+        return
+    
+    bouquets = await db.aio.get_bouquets_by_ids(match_id for match_id, _ in matches)
+    scores = {match_id: f"🎨 Сходство: {score:.0%}\n" for match_id, score in matches}
+    await update.message.reply_text(f"🎨 Похожие по цвету на букет #{bouquet_id}:")
+    await send_bouquet_cards(update.message, bouquets, extra_captions=scores)
+
+# Команда /backfill_hashes
+async def backfill_hashes_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Считает перцептивные хэши и палитры для букетов, у которых их ещё нет"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    bouquets = await db.aio.get_bouquets_without_features()
+    if not bouquets:
+        await update.message.reply_text("✅ Хэши и палитры уже посчитаны для всех букетов")
+        return
+    
+    status_msg = await update.message.reply_text(f"⏳ Считаю хэши и палитры для {len(bouquets)} букетов...")
+    
+    async def run():
+        semaphore = asyncio.Semaphore(Config.BACKFILL_CONCURRENCY)
+        variants = await db.aio.get_variants(bouquet.id for bouquet in bouquets)
+        counters = {'done': 0, 'failed': 0}
         
-        keyboard = [
-            [InlineKeyboardButton("📋 Список букетов", callback_data="list")],
-            [InlineKeyboardButton("🔄 Сгенерировать снова", callback_data=f"generate_{bouquet_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        async def backfill(bouquet):
+            async with semaphore:
+                # Маленький вариант дешевле скачать, чем оригинал
+                thumb = pick_variant(variants.get(bouquet.id, []), 0)
+                data = await storage.download_file(thumb.file_name if thumb else bouquet.file_name)
+                if data is None:
+                    counters['failed'] += 1
+                    return
+                try:
+                    phash, palette = await image_processor.analyze(data)
+                except Exception as e:
+                    logger.error(f"❌ Признаки букета #{bouquet.id}: {e}")
+                    counters['failed'] += 1
+                    return
+                phash = to_signed(phash)
+                await db.aio.set_image_features(bouquet.id, phash, palette)
+                _index_features(bouquet.id, phash, palette)
+                counters['done'] += 1
         
+        await asyncio.gather(*(backfill(bouquet) for bouquet in bouquets))
         await status_msg.edit_text(
-            f"✅ *Описание сгенерировано!*\n\n"
-            f"📝 {description}\n\n"
-            f"🌸 Букет #{bouquet_id}",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            f"✅ Хэши и палитры посчитаны!\n\n"
+            f"📸 Готово: {counters['done']}\n"
+            f"❌ Ошибок: {counters['failed']}"
         )
-    else:
-        await status_msg.edit_text("❌ Ошибка генерации описания")
+    
+    context.application.create_task(run(), update=update)
 
 # Обработчик callback-запросов
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -303,36 +1242,102 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     
     if data == "list":
-        bouquets = db.get_all_bouquets()
-        
-        if not bouquets:
-            await query.edit_message_text("📭 В базе пока нет букетов")
+        await query.edit_message_text("📋 Каталог букетов:")
+        await send_catalog_page(query.message)
+    
+    elif data.startswith("page_"):
+        # page_<n|p>_<номер страницы>_<unix-время>_<id>
+        _, direction, page, created, bouquet_id = data.split("_")
+        # Кнопки старой страницы убираем, чтобы не листать из середины истории
+        await query.edit_message_reply_markup(reply_markup=None)
+        await send_catalog_page(
+            query.message,
+            page=int(page),
+            cursor=(int(created), int(bouquet_id)),
+            backward=direction == "p"
+        )
+    
+    elif data.startswith("force_"):
+        # Повторяем загрузку, пропустив проверку на дубликаты
+        job = await db.aio.get_job(int(data.split("_")[1]))
+        if not job:
+            await query.edit_message_text("❌ Загрузка не найдена")
             return
-        
-        await query.edit_message_text(f"📊 Всего букетов: {len(bouquets)}")
-        
-        for bouquet in bouquets[:3]:
-            keyboard = [
-                [InlineKeyboardButton("✨ Сгенерировать описание", callback_data=f"generate_{bouquet['id']}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            caption = f"🌸 *Букет #{bouquet['id']}*\n"
-            if bouquet['description']:
-                caption += f"\n📝 {bouquet['description'][:100]}..."
-            else:
-                caption += "\n❌ Описание отсутствует"
-            
-            await query.message.reply_photo(
-                photo=bouquet['photo_url'],
-                caption=caption,
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-        
-    elif data.startswith("generate_"):
+        payload = dict(job.payload, force=True)
+        if job.kind == 'upload_album':
+            # Уже сохранённые фото альбома не загружаем второй раз
+            skipped = (job.result or {}).get('skipped', [])
+            payload['items'] = [payload['items'][index] for index in skipped]
+            if not payload['items']:
+                await query.edit_message_text("✅ Все фото альбома уже сохранены")
+                return
+        await query.edit_message_text("⏳ Сохраняю в облако...")
+        await enqueue_or_report(context.bot, job.kind, payload)
+    
+    elif data.startswith("generate_") or data.startswith("regenerate_"):
         bouquet_id = int(data.split("_")[1])
-        await generate_description(update, context, bouquet_id)
+        use_cache = data.startswith("generate_")
+        await generate_description(update, context, bouquet_id, use_cache=use_cache)
+
+# Команда /stats
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает статистику кэша YandexGPT, очереди задач и исходящих сообщений"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав")
+        return
+    
+    lines = []
+    cache = gpt.cache_stats()
+    if cache:
+        lines += [
+            "📈 *Кэш YandexGPT*",
+            f"✅ Попаданий: {cache['hits']}",
+            f"❌ Промахов: {cache['misses']}",
+            f"🎯 Доля попаданий: {cache['hit_ratio']:.0%}",
+            f"🗂 Записей: {cache['size']}",
+            f"⏱ Сэкономлено времени API: {cache['saved_seconds']:.1f} с",
+        ]
+    else:
+        lines.append("ℹ️ Кэш GPT отключен")
+    
+    records = db.cache.stats()
+    lines += [
+        "",
+        "🗃 *Кэш записей БД*",
+        f"🎯 Доля попаданий: {records['hit_ratio']:.0%} ({records['hits']} из {records['hits'] + records['misses']})",
+        f"🗂 Записей: {records['size']}",
+        f"♻️ Сбросов: {records['invalidations']}",
+    ]
+    
+    lines += ["", "📦 *Очередь задач*"]
+    for kind, counts in sorted((await db.aio.get_job_counts()).items()):
+        summary = ", ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+        lines.append(f"{kind} - {summary}".replace("_", "\\_"))
+    
+    posts = await db.aio.get_channel_post_counts()
+    if posts:
+        lines += ["", "📢 *Канал*", ", ".join(f"{status}: {count}" for status, count in sorted(posts.items()))]
+    
+    sending = outbox.stats()
+    lines += [
+        "",
+        "📤 *Исходящие сообщения*",
+        f"📬 В очереди: {sending['depth']} "
+        f"(ответы: {sending['depth_by_priority']['interactive']}, "
+        f"фоновые: {sending['depth_by_priority']['bulk']}, "
+        f"канал: {sending['depth_by_priority']['channel']})",
+        f"✅ Отправлено: {sending['sent']}",
+        f"🔁 Схлопнуто правок: {sending['coalesced']}",
+        f"🚦 RetryAfter: {sending['retry_after']}",
+    ]
+    if sending['wait_p50'] is not None:
+        lines.append(
+            f"⏱ Ожидание в очереди: p50 {sending['wait_p50']:.2f} с, p95 {sending['wait_p95']:.2f} с"
+        )
+    
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
 
 # Команда /admin
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -349,26 +1354,111 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Ошибка: {context.error}")
 
+async def on_startup(application: Application):
+    """Проверяет доступ к бакету, загружает индекс хэшей, запускает воркеры и автопостинг"""
+    await storage.check_access()
+    phash_index.load(await db.aio.get_phashes())
+    color_index.load(await db.aio.get_palettes())
+    await job_workers.start(application.bot)
+    if channel_autoposter is not None:
+        if application.job_queue is None:
+            logger.warning("⚠️ JobQueue недоступна (нужен python-telegram-bot[job-queue]), автопостинг выключен")
+        else:
+            await channel_autoposter.start(application.job_queue)
+
+async def on_shutdown(application: Application):
+    """Останавливает воркеры и освобождает общие соединения"""
+    await job_workers.stop()
+    await gpt.aclose()
+    await telegram_files.aclose()
+    image_processor.close()
+    storage.close()
+    db.close()
+
+def init_services():
+    """Создаёт сервисы с соединениями: вызывается один раз из main()"""
+    global db, storage, gpt, job_workers, bucket_sync, bucket_reconcile, channel_autoposter
+    db = Database(
+        workers=Config.DB_WORKERS,
+        mmap_size=Config.DB_MMAP_SIZE_MB * 1024 * 1024,
+        cache_size_kib=Config.DB_CACHE_SIZE_MB * 1024,
+        cache_entries=Config.DB_RECORD_CACHE_ENTRIES
+    )
+    storage = YandexStorageClient()
+    gpt = YandexGPT()
+    
+    # Очередь фоновых задач: обработчики только ставят задачи, работу делают воркеры
+    job_workers = JobWorkers(
+        db,
+        lease_seconds=Config.JOB_LEASE_SECONDS,
+        poll_interval=Config.JOB_POLL_INTERVAL,
+        max_attempts=Config.JOB_MAX_ATTEMPTS
+    )
+    
+    # Синхронизация бакета с базой (общая с sync_photos.py)
+    bucket_sync = BucketSync(
+        db, storage,
+        prefix='bouquets/',
+        batch_size=Config.SYNC_BATCH_SIZE,
+        progress_interval=Config.BULK_PROGRESS_INTERVAL,
+        lookback_seconds=Config.SYNC_LOOKBACK_SECONDS
+    )
+    
+    # Двусторонняя сверка бакета с базой и сборка мусора
+    bucket_reconcile = BucketReconcile(
+        db, storage,
+        batch_size=Config.SYNC_BATCH_SIZE,
+        grace_seconds=Config.RECONCILE_GRACE_SECONDS,
+        progress_interval=Config.BULK_PROGRESS_INTERVAL
+    )
+    
+    channel_autoposter = _build_channel_autoposter()
+
 def main():
     """Главная функция"""
+    init_services()
     force_reset_bot()
     start_health_server()
     logger.info("✅ Сервер здоровья запущен")
     
-    application = Application.builder().token(Config.BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(Config.BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .rate_limiter(outbox)
+    )
+    if Config.MAX_CONCURRENT_UPDATES > 1:
+        # Разные чаты обрабатываются параллельно, один чат - по порядку
+        builder = builder.concurrent_updates(
+            ChatOrderedUpdateProcessor(Config.MAX_CONCURRENT_UPDATES)
+        )
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("list", list_bouquets))
     application.add_handler(CommandHandler("generate", generate_command))
+    application.add_handler(CommandHandler("generate_all", generate_all_command))
     application.add_handler(CommandHandler("admin", admin))
     application.add_handler(CommandHandler("myid", show_my_id))
     application.add_handler(CommandHandler("sync", sync_photos))  # Новая команда
+    application.add_handler(CommandHandler("reconcile", reconcile_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("backfill_hashes", backfill_hashes_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("reindex", reindex_command))
+    application.add_handler(CommandHandler("similar", similar_command))
     
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_photo))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_error_handler(error_handler)
     
+    job_workers.register('upload', process_upload_job, Config.UPLOAD_WORKERS, on_failure=notify_job_failure)
+    job_workers.register('upload_album', process_album_job, Config.UPLOAD_WORKERS, on_failure=notify_job_failure)
+    job_workers.register('variants', process_variants_job, Config.IMAGE_WORKERS)
+    job_workers.register('generate', process_generate_job, Config.GENERATE_WORKERS, on_failure=notify_job_failure)
+    
     logger.info("🚀 Бот контента запущен...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
@@ -0,0 +1,321 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import timezone
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def object_file_id(key: str) -> str:
+    """file_id для объекта, загруженного мимо бота: имя файла без папки и расширения"""
+    return os.path.splitext(os.path.basename(key))[0]
+
+
+def _timestamp(last_modified) -> float:
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return last_modified.timestamp()
+
+
+class BucketSync:
+    """Инкрементальная синхронизация объектов бакета с таблицей bouquets.
+
+    Листинг S3 идёт по всем страницам (ContinuationToken). Листинг
+    упорядочен по ключу, а не по времени, поэтому пройти его приходится
+    целиком, но в базу попадают только объекты новее водяного знака -
+    (LastModified, ETag) самого свежего объекта прошлого прогона из
+    таблицы sync_state. Новые строки пишутся executemany-пачками в одной
+    транзакции вместе с новым водяным знаком: он сдвигается, только если
+    записались все строки. Общий движок для команды /sync и sync_photos.py.
+
+    Водяной знак не бывает новее lookback_seconds до начала прогона:
+    объект, записанный во время листинга под уже пройденным ключом, или
+    multipart-загрузка (LastModified - время её начала) попадут в окно
+    следующего прогона. Повторно увиденные ключи база отбрасывает по file_name.
+    Добавленным букетам ставятся задачи 'variants' - их выполнят воркеры бота.
+    """
+
+    def __init__(self, db, storage, prefix='bouquets/', batch_size=500, page_size=1000,
+                 progress_interval=3.0, lookback_seconds=24 * 3600):
+        self.db = db
+        self.storage = storage
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.lookback_seconds = lookback_seconds
+
+    async def run(self, on_progress: Optional[Callable[[dict], Awaitable[None]]] = None,
+                  full: bool = False) -> dict:
+        """Синхронизирует префикс; full=True игнорирует водяной знак.
+
+        on_progress(progress) вызывается не чаще progress_interval секунд и в
+        конце; progress - dict (stage, pages, scanned, new, added, total_new).
+        """
+        loop = asyncio.get_running_loop()
+        progress = {'stage': 'listing', 'pages': 0, 'scanned': 0, 'new': 0, 'added': 0}
+        last_report = 0.0
+
+        async def report(force=False):
+            nonlocal last_report
+            if on_progress is None:
+                return
+            if force or loop.time() - last_report >= self.progress_interval:
+                last_report = loop.time()
+                try:
+                    await on_progress(dict(progress))
+                except Exception as e:
+                    logger.debug(f"Не удалось показать прогресс синхронизации: {e}")
+
+        started = time.time()
+        state = None if full else await self.db.aio.get_sync_state(self.prefix)
+        since, since_etag = state if state else (None, None)
+        watermark = state
+
+        rows = []
+        token = None
+        while True:
+            objects, token = await self.storage.list_objects_page(
+                prefix=self.prefix, continuation_token=token, max_keys=self.page_size
+            )
+            progress['pages'] += 1
+            progress['scanned'] += len(objects)
+            for obj in objects:
+                key = obj['Key']
+                if key.endswith('/'):
+                    continue
+                modified = _timestamp(obj['LastModified'])
+                etag = obj.get('ETag', '').strip('"')
+                if since is not None and (modified < since or (modified == since and etag == since_etag)):
+                    continue
+                rows.append((object_file_id(key), self.storage.get_file_url(key), key))
+                if watermark is None or modified > watermark[0]:
+                    watermark = (modified, etag)
+            progress['new'] = len(rows)
+            await report()
+            if not token:
+                break
+
+        # Свежие объекты остаются в окне следующего прогона
+        cap = started - self.lookback_seconds
+        if watermark is not None and watermark[0] > cap:
+            watermark = (cap, None)
+
+        progress['stage'] = 'writing'
+        progress['total_new'] = len(rows)
+        await report(force=True)
+
+        def on_batch(added):
+            # Вызывается из потока БД; прогресс читает цикл событий
+            progress['added'] = added
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                await report(force=True)
+
+        report_task = asyncio.create_task(reporter()) if rows and on_progress else None
+        try:
+            added = await self.db.aio.add_bouquet_urls(
+                rows, prefix=self.prefix, watermark=watermark,
+                batch_size=self.batch_size, on_batch=on_batch
+            )
+        finally:
+            if report_task is not None:
+                report_task.cancel()
+        if added is None:
+            raise RuntimeError("Не удалось записать объекты в базу")
+        progress['added'] = added
+        # Уменьшенные копии новым букетам строят воркеры бота
+        progress['variants_queued'] = await self.db.aio.enqueue_missing_variants() if added else 0
+
+        progress['stage'] = 'done'
+        logger.info(
+            f"✅ Синхронизация {self.prefix}: страниц {progress['pages']}, объектов {progress['scanned']}, "
+            f"новых {len(rows)}, добавлено {progress['added']}"
+        )
+        await report(force=True)
+        return progress
+
+
+async def _bucket_keys(storage, prefix, page_size):
+    """Ключи префикса (key, last_modified) в порядке листинга S3, постранично"""
+    token = None
+    while True:
+        objects, token = await storage.list_objects_page(
+            prefix=prefix, continuation_token=token, max_keys=page_size
+        )
+        for obj in objects:
+            if not obj['Key'].endswith('/'):
+                yield obj['Key'], _timestamp(obj['LastModified'])
+        if not token:
+            return
+
+
+async def _db_keys(db, table, prefix, page_size):
+    """Строки (file_name, rowid) таблицы в том же порядке, keyset-страницами"""
+    after = None
+    while True:
+        rows = await db.aio.get_file_names_page(table, prefix, after=after, limit=page_size)
+        if rows is None:
+            raise RuntimeError(f"Не удалось прочитать {table} из базы")
+        for row in rows:
+            yield tuple(row)
+        if len(rows) < page_size:
+            return
+        after = tuple(rows[-1])
+
+
+async def _next(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class BucketReconcile:
+    """Двусторонняя сверка бакета с базой за один проход слиянием.
+
+    Листинг S3 и столбец file_name (индекс, сравнение BINARY) идут в
+    одном порядке - по байтам UTF-8, поэтому оба потока читаются
+    постранично и сливаются как отсортированные последовательности:
+    в памяти только текущие страницы и пачки на исправление.
+
+    Расхождения по коллекциям:
+    - bouquets/: объект без строки импортируется в базу (с задачей
+      'variants'), строка без объекта удаляется вместе с вариантами и историей;
+    - variants/: объект без строки - мусор, удаляется пачками
+      DeleteObjects по 1000 ключей; строка без объекта удаляется.
+    Объекты моложе grace_seconds не трогаются: загрузка могла ещё не
+    дописать строку. Без fix=True расхождения только считаются.
+    """
+
+    # (префикс, таблица, что делать с объектом без строки)
+    COLLECTIONS = (
+        ('bouquets/', 'bouquets', 'import'),
+        ('variants/', 'bouquet_variants', 'delete'),
+    )
+
+    def __init__(self, db, storage, page_size=1000, batch_size=500, delete_batch_size=1000,
+                 grace_seconds=3600, sample_size=5, progress_interval=3.0):
+        self.db = db
+        self.storage = storage
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.delete_batch_size = min(delete_batch_size, 1000)
+        self.grace_seconds = grace_seconds
+        self.sample_size = sample_size
+        self.progress_interval = progress_interval
+
+    async def run(self, fix: bool = False,
+                  on_progress: Optional[Callable[[dict], Awaitable[None]]] = None,
+                  on_bouquets_deleted: Optional[Callable[[list], None]] = None) -> dict:
+        """Сверяет все коллекции; возвращает dict с итогами по каждой.
+
+        on_bouquets_deleted(ids) вызывается после удаления строк букетов,
+        чтобы вызывающий мог убрать их из индексов в памяти.
+        """
+        loop = asyncio.get_running_loop()
+        last_report = 0.0
+        results = {}
+
+        for prefix, table, orphan_action in self.COLLECTIONS:
+            result = {
+                'prefix': prefix, 'objects': 0, 'rows': 0, 'matched': 0,
+                'missing_rows': 0, 'missing_objects': 0, 'skipped_recent': 0,
+                'imported': 0, 'deleted_objects': 0, 'deleted_rows': 0,
+                'samples_missing_rows': [], 'samples_missing_objects': [],
+            }
+            results[prefix] = result
+            orphan_keys = []
+            orphan_rows = []
+            cutoff = time.time() - self.grace_seconds
+
+            async def flush_objects():
+                if not orphan_keys:
+                    return
+                if orphan_action == 'import':
+                    added = await self.db.aio.add_bouquet_urls([
+                        (object_file_id(key), self.storage.get_file_url(key), key) for key in orphan_keys
+                    ], batch_size=self.batch_size)
+                    if added is None:
+                        raise RuntimeError("Не удалось записать объекты в базу")
+                    result['imported'] += added
+                else:
+                    result['deleted_objects'] += await self.storage.delete_objects(orphan_keys)
+                orphan_keys.clear()
+
+            async def flush_rows():
+                if not orphan_rows:
+                    return
+                if table == 'bouquets':
+                    result['deleted_rows'] += await self.db.aio.delete_bouquets(orphan_rows)
+                    if on_bouquets_deleted is not None:
+                        on_bouquets_deleted(list(orphan_rows))
+                else:
+                    result['deleted_rows'] += await self.db.aio.delete_variant_rows(orphan_rows)
+                orphan_rows.clear()
+
+            async def report():
+                nonlocal last_report
+                if on_progress is None or loop.time() - last_report < self.progress_interval:
+                    return
+                last_report = loop.time()
+                try:
+                    await on_progress(dict(result))
+                except Exception as e:
+                    logger.debug(f"Не удалось показать прогресс сверки: {e}")
+
+            objects = _bucket_keys(self.storage, prefix, self.page_size)
+            rows = _db_keys(self.db, table, prefix, self.page_size)
+            obj = await _next(objects)
+            row = await _next(rows)
+            while obj is not None or row is not None:
+                if row is None or (obj is not None and obj[0] < row[0]):
+                    key, modified = obj
+                    result['objects'] += 1
+                    if modified > cutoff:
+                        result['skipped_recent'] += 1
+                    else:
+                        result['missing_rows'] += 1
+                        if len(result['samples_missing_rows']) < self.sample_size:
+                            result['samples_missing_rows'].append(key)
+                        if fix:
+                            orphan_keys.append(key)
+                            if len(orphan_keys) >= self.delete_batch_size:
+                                await flush_objects()
+                    obj = await _next(objects)
+                    await report()
+                elif obj is None or row[0] < obj[0]:
+                    file_name, rowid = row
+                    result['rows'] += 1
+                    result['missing_objects'] += 1
+                    if len(result['samples_missing_objects']) < self.sample_size:
+                        result['samples_missing_objects'].append(file_name)
+                    if fix:
+                        orphan_rows.append(rowid)
+                        if len(orphan_rows) >= self.batch_size:
+                            await flush_rows()
+                    row = await _next(rows)
+                else:
+                    result['rows'] += 1
+                    result['matched'] += 1
+                    row = await _next(rows)
+                    # Несколько строк с одним file_name сопоставляются одному объекту
+                    if row is None or row[0] != obj[0]:
+                        result['objects'] += 1
+                        obj = await _next(objects)
+            await flush_objects()
+            await flush_rows()
+            if result['imported']:
+                result['variants_queued'] = await self.db.aio.enqueue_missing_variants()
+
+            logger.info(
+                f"🔎 Сверка {prefix}: объектов {result['objects']}, строк {result['rows']}, "
+                f"без строки {result['missing_rows']}, без объекта {result['missing_objects']}, "
+                f"импортировано {result['imported']}, удалено объектов {result['deleted_objects']}, "
+                f"удалено строк {result['deleted_rows']}"
+            )
+        return results
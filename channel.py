@@ -0,0 +1,171 @@
+import logging
+from datetime import datetime, time, timedelta, timezone
+from typing import Any, Awaitable, Callable
+
+from concurrency import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+PrepareHandler = Callable[[Any, Any], Awaitable[None]]
+PublishHandler = Callable[[Any, Any], Awaitable[int]]
+
+
+def parse_post_times(spec: str) -> list:
+    """'10:00, 19:30' -> отсортированный список datetime.time"""
+    times = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        hour, _, minute = part.partition(':')
+        times.add(time(int(hour), int(minute or 0)))
+    return sorted(times)
+
+
+class PostSchedule:
+    """Расписание публикаций: одинаковое время каждый день в часовом поясе канала"""
+
+    def __init__(self, times, tz):
+        if not times:
+            raise ValueError("Пустое расписание публикаций")
+        self.times = list(times)
+        self.tz = tz
+
+    def slots_after(self, moment: datetime):
+        """Бесконечная последовательность слотов строго позже moment"""
+        day = moment.astimezone(self.tz).date()
+        while True:
+            for post_time in self.times:
+                slot = datetime.combine(day, post_time, tzinfo=self.tz)
+                if slot > moment:
+                    yield slot
+            day += timedelta(days=1)
+
+    def slots_between(self, start: datetime, end: datetime) -> list:
+        """Слоты в полуинтервале (start, end]"""
+        slots = []
+        for slot in self.slots_after(start):
+            if slot > end:
+                return slots
+            slots.append(slot)
+
+
+class ChannelAutoposter:
+    """Автопостинг в канал по расписанию на JobQueue.
+
+    Для каждого слота ставятся две разовые задачи: подготовка за
+    prefetch_seconds до слота (prepare(bot, bouquet) - описание, вариант
+    изображения, file_id в Telegram) и сама публикация, которая сводится
+    к одной отправке publish(bot, bouquet) -> message_id. Если подготовка
+    не успела, публикация делает её сама; пост без описания не
+    публикуется - слот помечается skipped, а букет достанется следующему.
+
+    Состояние слотов хранится в channel_posts: букет закрепляется за
+    слотом один раз, публикацию захватывает переход в posting, поэтому
+    повторный запуск задачи или рестарт не дают дублей. Слоты, пропущенные
+    пока бот был выключен, публикуются при старте, если опоздание не
+    больше catchup_seconds.
+    """
+
+    def __init__(self, db, schedule: PostSchedule, prepare: PrepareHandler, publish: PublishHandler,
+                 prefetch_seconds: float = 3600, catchup_seconds: float = 1800):
+        self.db = db
+        self.schedule = schedule
+        self.prepare = prepare
+        self.publish = publish
+        self.prefetch_seconds = prefetch_seconds
+        self.catchup_seconds = catchup_seconds
+        # Подготовка одного слота из задачи prefetch и из публикации выполняется один раз
+        self._preparing = SingleFlight()
+
+    async def start(self, job_queue):
+        abandoned = await self.db.aio.abandon_channel_posts()
+        if abandoned:
+            logger.warning(f"⚠️ Публикаций, прерванных перезапуском: {abandoned}")
+
+        now = datetime.now(timezone.utc)
+        for slot in self.schedule.slots_between(now - timedelta(seconds=self.catchup_seconds), now):
+            logger.info(f"📢 Догоняю пропущенный слот {slot:%d.%m %H:%M}")
+            job_queue.run_once(self._publish_job, 0, data=slot, name=f"channel_catchup_{slot:%Y%m%d%H%M}")
+        self._schedule_next(job_queue, now)
+
+    def _schedule_next(self, job_queue, after: datetime):
+        slot = next(self.schedule.slots_after(after))
+        now = datetime.now(timezone.utc)
+        prefetch_in = max(0.0, (slot - now).total_seconds() - self.prefetch_seconds)
+        publish_in = max(0.0, (slot - now).total_seconds())
+        job_queue.run_once(self._prefetch_job, prefetch_in, data=slot, name=f"channel_prefetch_{slot:%Y%m%d%H%M}")
+        job_queue.run_once(self._publish_job, publish_in, data=slot, name=f"channel_post_{slot:%Y%m%d%H%M}")
+        logger.info(f"📅 Следующая публикация в канал: {slot:%d.%m %H:%M %Z}")
+
+    async def _prefetch_job(self, context):
+        try:
+            await self.prepare_slot(context.bot, context.job.data)
+        except Exception as e:
+            # Не страшно: публикация попробует подготовить пост ещё раз
+            logger.error(f"❌ Ошибка подготовки публикации {context.job.data:%d.%m %H:%M}: {e}")
+
+    async def _publish_job(self, context):
+        slot = context.job.data
+        if context.job.name.startswith('channel_post_'):
+            # Следующий слот планируется сразу, даже если эта публикация упадёт
+            self._schedule_next(context.job_queue, slot)
+        await self.publish_slot(context.bot, slot)
+
+    async def prepare_slot(self, bot, slot: datetime):
+        """Закрепляет букет за слотом и готовит пост; True, если пост готов"""
+        key = int(slot.timestamp())
+        ready, _ = await self._preparing.do(key, lambda: self._prepare(bot, key))
+        return ready
+
+    async def _prepare(self, bot, key: int) -> bool:
+        post = await self.db.aio.plan_channel_post(key)
+        if post is None:
+            logger.warning("⚠️ Для публикации в канал не осталось букетов")
+            return False
+        if post.status != 'planned':
+            return post.status == 'ready'
+
+        bouquet = await self.db.aio.get_bouquet(post.bouquet_id)
+        if bouquet is None:
+            await self.db.aio.set_channel_post_status(key, 'failed', expected=('planned',), error="букет удалён")
+            return False
+        await self.prepare(bot, bouquet)
+        await self.db.aio.set_channel_post_status(key, 'ready', expected=('planned',))
+        logger.info(f"✅ Публикация букета #{bouquet.id} подготовлена")
+        return True
+
+    async def publish_slot(self, bot, slot: datetime):
+        key = int(slot.timestamp())
+        try:
+            await self.prepare_slot(bot, slot)
+        except Exception as e:
+            logger.error(f"❌ Ошибка подготовки публикации: {e}")
+
+        post = await self.db.aio.get_channel_post(key)
+        if post is None or post.status not in ('planned', 'ready'):
+            return
+        bouquet = await self.db.aio.get_bouquet(post.bouquet_id)
+        if post.status == 'planned':
+            if bouquet is None or not bouquet.description:
+                # Без описания не публикуем: слот пропускается, букет вернётся в очередь
+                logger.warning(f"⚠️ Пост для букета #{post.bouquet_id} не подготовлен, слот пропущен")
+                await self.db.aio.set_channel_post_status(
+                    key, 'skipped', expected=('planned',), error="пост не подготовлен"
+                )
+                return
+            logger.warning(f"⚠️ Пост для букета #{post.bouquet_id} подготовлен не полностью, публикую по ссылке")
+
+        # Захват слота: публикует только тот, кто перевёл его в posting
+        if not await self.db.aio.set_channel_post_status(key, 'posting', expected=('planned', 'ready')):
+            return
+        try:
+            if bouquet is None:
+                raise RuntimeError("букет удалён")
+            message_id = await self.publish(bot, bouquet)
+        except Exception as e:
+            logger.error(f"❌ Ошибка публикации букета #{post.bouquet_id} в канал: {e}")
+            await self.db.aio.set_channel_post_status(key, 'failed', error=str(e))
+            return
+        await self.db.aio.set_channel_post_status(key, 'posted', message_id=message_id)
+        logger.info(f"📢 Букет #{bouquet.id} опубликован в канале")
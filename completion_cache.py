@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionCache:
+    """Кэш ответов YandexGPT в SQLite с TTL и LRU-вытеснением.
+
+    Ключ - sha256 от (modelUri, messages, temperature, maxTokens), поэтому
+    одинаковые запросы с одинаковыми параметрами модели не уходят в API.
+    Число записей считается один раз при открытии и дальше ведётся при
+    вставке и удалении, так что stats() не обращается к SQLite.
+    """
+
+    def __init__(self, db_name="gpt_cache.db", ttl_seconds=7 * 24 * 3600, max_entries=5000):
+        self.db_name = db_name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                latency REAL,
+                created_at REAL,
+                last_used_at REAL
+            )
+        ''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_completions_last_used ON completions (last_used_at)'
+        )
+        self.conn.commit()
+        (self._size,) = self.conn.execute('SELECT COUNT(*) FROM completions').fetchone()
+        logger.info(f"✅ Кэш GPT подключен: {self.db_name}")
+
+    @staticmethod
+    def make_key(payload: dict) -> str:
+        """Хэш значимых для ответа полей запроса (stream на ответ не влияет)"""
+        options = payload.get('completionOptions', {})
+        material = json.dumps(
+            {
+                'modelUri': payload.get('modelUri'),
+                'messages': payload.get('messages'),
+                'temperature': options.get('temperature'),
+                'maxTokens': options.get('maxTokens'),
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT response, latency, created_at FROM completions WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or now - row[2] > self.ttl_seconds:
+                if row is not None:
+                    self.conn.execute('DELETE FROM completions WHERE key = ?', (key,))
+                    self.conn.commit()
+                    self._size -= 1
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE completions SET last_used_at = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+            self.hits += 1
+            self.saved_seconds += row[1] or 0.0
+            return row[0]
+
+    def set(self, key: str, response: str, latency: float = 0.0):
+        now = time.time()
+        with self._lock:
+            exists = self.conn.execute('SELECT 1 FROM completions WHERE key = ?', (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO completions (key, response, latency, created_at, last_used_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, response, latency, now, now)
+            )
+            size = self._size + (0 if exists else 1)
+            # Вытесняем давно не использованные записи сверх лимита
+            if size > self.max_entries:
+                cursor = self.conn.execute(
+                    'DELETE FROM completions WHERE key IN '
+                    '(SELECT key FROM completions ORDER BY last_used_at LIMIT ?)',
+                    (size - self.max_entries,)
+                )
+                size -= max(cursor.rowcount, 0)
+            self.conn.commit()
+            self._size = size
+
+    def stats(self) -> dict:
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0.0,
+            'size': self._size,
+            'saved_seconds': self.saved_seconds,
+        }
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
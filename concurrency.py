@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка внутри чата.
+
+    Апдейты из разных чатов выполняются одновременно (не больше
+    max_concurrent_updates), апдейты одного чата - строго по очереди.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_pending: Dict[Hashable, int] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[Hashable]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        # Сначала ждём свою очередь в чате и только потом занимаем общий слот,
+        # чтобы один "болтливый" чат не выбирал весь лимит воркеров
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+        self._chat_pending[key] = self._chat_pending.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._chat_pending[key] -= 1
+            if not self._chat_pending[key]:
+                del self._chat_pending[key]
+                del self._chat_locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом в один.
+
+    Пока задача по ключу выполняется, все новые вызовы ждут её результат
+    вместо того, чтобы запускать работу повторно.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._tasks
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Возвращает (результат, shared), где shared - результат чужого вызова"""
+        task = self._tasks.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+
+            def _forget(done, key=key):
+                if self._tasks.get(key) is done:
+                    del self._tasks[key]
+
+            task.add_done_callback(_forget)
+        # shield: отмена одного ожидающего не отменяет общую работу
+        return await asyncio.shield(task), shared
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 10.0) -> float:
+    """Экспоненциальная задержка с полным джиттером для попытки attempt (с 0)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class LatencyTracker:
+    """Скользящее окно задержек для оценки перцентилей.
+
+    Пишет цикл событий, а читать может и поток сервера метрик, поэтому
+    окно копируется под блокировкой: сортировка deque, в который
+    параллельно добавляют, падает с RuntimeError.
+    """
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонён: автомат разомкнут после серии ошибок"""
+
+
+class CircuitBreaker:
+    """Автоматический выключатель: после failure_threshold ошибок подряд
+    отклоняет вызовы reset_timeout секунд, затем пропускает один пробный.
+
+    check() возвращает номер пробного вызова (None для обычного); вызов,
+    завершившийся без record_success/record_failure (например, отменённый),
+    должен вернуть его через release(probe), иначе автомат останется
+    полуоткрытым и будет отклонять всё.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, name: str = ''):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_seq = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        # HALF_OPEN: пропускаем ровно один пробный вызов
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        self._probe_seq += 1
+        return True
+
+    def check(self) -> Optional[int]:
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name or 'circuit'} is open")
+        return self._probe_seq if self._probe_in_flight else None
+
+    def release(self, probe: Optional[int]) -> None:
+        """Снимает пробный вызов, если он ещё числится за этим вызывающим"""
+        if probe is not None and self._probe_in_flight and self._probe_seq == probe:
+            self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"✅ {self.name}: автомат замкнут")
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"⚠️ {self.name}: автомат разомкнут на {self.reset_timeout:.0f} с")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class TokenBucket:
+    """Асинхронный ограничитель частоты: rate токенов в секунду, запас capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """Сколько секунд ждать, пока наберётся tokens (0 - можно сейчас)"""
+        self._refill()
+        needed = min(tokens, self.capacity)
+        return 0.0 if self._tokens >= needed else (needed - self._tokens) / self.rate
+
+    def consume(self, tokens: float = 1.0) -> None:
+        """Списывает токены без ожидания; запас может уйти в минус (долг)"""
+        self._refill()
+        self._tokens -= tokens
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        # Lock выстраивает ожидающих в очередь (FIFO)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
@@ -21,3 +21,82 @@ class Config:
     
     # Канал
     CHANNEL_ID = os.getenv('CHANNEL_ID')
+    
+    # Автопостинг: время публикаций (ЧЧ:ММ через запятую) в часовом поясе канала
+    CHANNEL_POST_TIMES = os.getenv('CHANNEL_POST_TIMES', '11:00,19:00')
+    CHANNEL_TIMEZONE = os.getenv('CHANNEL_TIMEZONE', 'Europe/Moscow')
+    # Подготовка поста (описание, вариант фото, file_id) заранее до слота
+    CHANNEL_PREFETCH_MINUTES = int(os.getenv('CHANNEL_PREFETCH_MINUTES', '60'))
+    # Слоты, пропущенные пока бот был выключен, публикуются с опозданием не больше этого
+    CHANNEL_CATCHUP_MINUTES = int(os.getenv('CHANNEL_CATCHUP_MINUTES', '30'))
+    # Чат, куда фото отправляется заранее ради file_id (по умолчанию первый админ)
+    CHANNEL_PREFETCH_CHAT = os.getenv('CHANNEL_PREFETCH_CHAT') or (str(ADMIN_IDS[0]) if ADMIN_IDS else None)
+    
+    # Обработка апдейтов
+    MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '16'))
+    
+    # SQLite: потоки для асинхронных запросов и размеры кэшей
+    DB_WORKERS = int(os.getenv('DB_WORKERS', '4'))
+    DB_MMAP_SIZE_MB = int(os.getenv('DB_MMAP_SIZE_MB', '256'))
+    DB_CACHE_SIZE_MB = int(os.getenv('DB_CACHE_SIZE_MB', '32'))
+    DB_RECORD_CACHE_ENTRIES = int(os.getenv('DB_RECORD_CACHE_ENTRIES', '1024'))
+    
+    # Очередь исходящих сообщений (лимиты Telegram: ~30 сообщений/с на бота,
+    # ~1/с в личный чат, ~20/мин в группу или канал)
+    OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '25'))
+    OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1.0'))
+    OUTBOX_GROUP_RATE = float(os.getenv('OUTBOX_GROUP_RATE', str(20 / 60)))
+    OUTBOX_CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', '3'))
+    OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '3'))
+    
+    # Потоковая генерация описаний
+    GPT_STREAMING = os.getenv('GPT_STREAMING', '1') not in ('0', 'false', 'False', '')
+    STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+    
+    # Массовая генерация (/generate_all)
+    BULK_WORKERS = int(os.getenv('BULK_WORKERS', '4'))
+    BULK_GPT_RPS = float(os.getenv('BULK_GPT_RPS', '1.0'))
+    BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', '20'))
+    BULK_PROGRESS_INTERVAL = float(os.getenv('BULK_PROGRESS_INTERVAL', '3.0'))
+    
+    # Синхронизация с бакетом: строк в одной пачке записи
+    SYNC_BATCH_SIZE = int(os.getenv('SYNC_BATCH_SIZE', '500'))
+    # Окно повторного просмотра /sync: водяной знак не новее начала прогона минус окно
+    SYNC_LOOKBACK_SECONDS = int(os.getenv('SYNC_LOOKBACK_SECONDS', str(24 * 3600)))
+    # Сверка (/reconcile): объекты моложе этого срока считаются недозагруженными
+    RECONCILE_GRACE_SECONDS = int(os.getenv('RECONCILE_GRACE_SECONDS', '3600'))
+    
+    # Очередь фоновых задач
+    UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+    GENERATE_WORKERS = int(os.getenv('GENERATE_WORKERS', '4'))
+    JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '120'))
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '5.0'))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+    
+    # Альбомы: сколько ждать следующее фото группы, прежде чем закрыть пачку
+    ALBUM_COLLECT_DELAY = float(os.getenv('ALBUM_COLLECT_DELAY', '1.5'))
+    
+    # Варианты изображений
+    IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+    CARD_PHOTO_SIDE = int(os.getenv('CARD_PHOTO_SIDE', '320'))
+    # Фото для поста в канале: самый лёгкий вариант с большей стороной не меньше этой
+    POST_PHOTO_SIDE = int(os.getenv('POST_PHOTO_SIDE', '1280'))
+    
+    # /list: карточек на странице каталога
+    LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', '5'))
+    
+    # Поиск почти-дубликатов: допустимое отличие хэшей (бит из 64)
+    DUPLICATE_MAX_DISTANCE = int(os.getenv('DUPLICATE_MAX_DISTANCE', '6'))
+    # Хэш, где единиц или нулей меньше стольких бит (однотонный фон, размытое фото),
+    # считается дубликатом, только если совпадает и палитра - с близостью не ниже порога
+    DUPLICATE_MIN_HASH_BITS = int(os.getenv('DUPLICATE_MIN_HASH_BITS', '8'))
+    DUPLICATE_MIN_COLOR_SCORE = float(os.getenv('DUPLICATE_MIN_COLOR_SCORE', '0.9'))
+    BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', '4'))
+    
+    # /search: сколько найденных букетов показывать
+    SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', '5'))
+    
+    # /similar: сколько похожих по цвету букетов показывать
+    SIMILAR_LIMIT = int(os.getenv('SIMILAR_LIMIT', '5'))
+    # Минимальная косинусная близость палитр, ниже которой букеты не считаются похожими
+    SIMILAR_MIN_SCORE = float(os.getenv('SIMILAR_MIN_SCORE', '0.3'))
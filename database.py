@@ -1,111 +1,637 @@
+import asyncio
+import re
 import sqlite3
 import logging
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
+
+from metrics import Histogram
+from record_cache import RecordCache
 
 logger = logging.getLogger(__name__)
 
+# --- Записи ---
+# Строки возвращаются кортежами с именованными полями: меньше памяти и
+# аллокаций, чем dict на строку, доступ - bouquet.id, variant.photo_url.
+
+Bouquet = namedtuple('Bouquet', (
+    'id', 'file_id', 'photo_url', 'file_name', 'name', 'description', 'created_at',
+    'phash', 'palette', 'tg_file_id', 'created_ts'
+))
+BOUQUET_COLUMNS = (
+    "id, file_id, photo_url, file_name, name, description, created_at, "
+    "phash, palette, tg_file_id, CAST(strftime('%s', created_at) AS INTEGER)"
+)
+
+Variant = namedtuple('Variant', (
+    'bouquet_id', 'variant', 'file_name', 'photo_url', 'content_type', 'width', 'height', 'size', 'tg_file_id'
+))
+VARIANT_COLUMNS = 'bouquet_id, variant, file_name, photo_url, content_type, width, height, size, tg_file_id'
+
+Job = namedtuple('Job', ('id', 'kind', 'payload', 'status', 'attempts', 'max_attempts', 'result'))
+JOB_COLUMNS = 'id, kind, payload, status, attempts, max_attempts, result'
+
+
+ChannelPost = namedtuple('ChannelPost', ('slot', 'bouquet_id', 'status', 'message_id', 'error'))
+CHANNEL_POST_COLUMNS = 'slot, bouquet_id, status, message_id, error'
+
+SearchHit = namedtuple('SearchHit', ('bouquet_id', 'snippet', 'score', 'source'))
+
+
+def _fts_query(text):
+    """Запрос пользователя -> выражение FTS5: все слова как префиксы, без операторов FTS"""
+    words = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _job(row):
+    return Job(row[0], row[1], json.loads(row[2]) if row[2] else {}, *row[3:6], json.loads(row[6]) if row[6] else None)
+
+
+# --- Миграции ---
+# Каждая миграция получает соединение внутри транзакции. Базы, созданные
+# до появления миграций (user_version = 0), уже могут содержать часть схемы,
+# поэтому ранние шаги идемпотентны.
+
+def _add_column(conn, table, column, definition):
+    """Добавляет колонку, если её ещё нет"""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _migration_initial(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bouquets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT UNIQUE,
+            photo_url TEXT,
+            file_name TEXT,
+            name TEXT DEFAULT "Букет",
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bouquet_id INTEGER,
+            prompt TEXT,
+            description TEXT,
+            model TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (bouquet_id) REFERENCES bouquets (id)
+        )
+    ''')
+
+
+def _migration_jobs(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER DEFAULT 5,
+            available_at REAL,
+            lease_until REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (kind, status, available_at)')
+
+
+def _migration_variants(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bouquet_variants (
+            bouquet_id INTEGER,
+            variant TEXT,
+            file_name TEXT,
+            photo_url TEXT,
+            content_type TEXT,
+            width INTEGER,
+            height INTEGER,
+            size INTEGER,
+            PRIMARY KEY (bouquet_id, variant),
+            FOREIGN KEY (bouquet_id) REFERENCES bouquets (id)
+        )
+    ''')
+
+
+def _migration_image_features(conn):
+    # Перцептивный хэш фото и цветовая гистограмма (упакованный float32)
+    _add_column(conn, 'bouquets', 'phash', 'INTEGER')
+    _add_column(conn, 'bouquets', 'palette', 'BLOB')
+
+
+def _migration_tg_file_ids(conn):
+    # file_id фото, которое Telegram вернул при первой отправке
+    _add_column(conn, 'bouquets', 'tg_file_id', 'TEXT')
+    _add_column(conn, 'bouquet_variants', 'tg_file_id', 'TEXT')
+
+
+def _migration_indexes(conn):
+    # Поиск страницы каталога по ключу (created_at, id) без чтения таблицы
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bouquets_created ON bouquets (created_at, id)')
+    # История генераций букета по времени
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_generations_bouquet ON generations (bouquet_id, created_at)'
+    )
+    # Очередь /generate_all - только букеты без описания
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_bouquets_no_description ON bouquets (id) '
+        "WHERE description IS NULL OR description = ''"
+    )
+
+
+def _migration_search(conn):
+    # Полнотекстовый поиск: внешний контент (текст хранится только в исходных
+    # таблицах), индекс поддерживают триггеры. Название весит больше описания.
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS bouquets_fts USING fts5("
+        "name, description, content='bouquets', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    conn.execute("INSERT INTO bouquets_fts (bouquets_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')")
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS bouquets_fts_insert AFTER INSERT ON bouquets BEGIN
+            INSERT INTO bouquets_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS bouquets_fts_delete AFTER DELETE ON bouquets BEGIN
+            INSERT INTO bouquets_fts (bouquets_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS bouquets_fts_update AFTER UPDATE OF name, description ON bouquets BEGIN
+            INSERT INTO bouquets_fts (bouquets_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO bouquets_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5("
+        "description, content='generations', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+            INSERT INTO generations_fts (rowid, description) VALUES (new.id, new.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+            INSERT INTO generations_fts (generations_fts, rowid, description)
+            VALUES ('delete', old.id, old.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS generations_fts_update AFTER UPDATE OF description ON generations BEGIN
+            INSERT INTO generations_fts (generations_fts, rowid, description)
+            VALUES ('delete', old.id, old.description);
+            INSERT INTO generations_fts (rowid, description) VALUES (new.id, new.description);
+        END
+    ''')
+    
+    # Индексируем то, что уже есть в базе
+    conn.execute("INSERT INTO bouquets_fts (bouquets_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO generations_fts (generations_fts) VALUES ('rebuild')")
+
+
+def _migration_sync_state(conn):
+    # Водяной знак синхронизации с бакетом: самый свежий обработанный объект префикса
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            prefix TEXT PRIMARY KEY,
+            last_modified REAL,
+            etag TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migration_channel_skipped(conn):
+    # Пропущенный слот (skipped) не закрепляет букет: он уйдёт в следующий
+    conn.execute('DROP INDEX IF EXISTS idx_channel_posts_bouquet')
+    conn.execute(
+        "CREATE UNIQUE INDEX idx_channel_posts_bouquet ON channel_posts (bouquet_id) WHERE status != 'skipped'"
+    )
+
+
+def _migration_job_result(conn):
+    # Результат выполненной задачи (например, какие фото альбома пропущены как дубликаты)
+    _add_column(conn, 'jobs', 'result', 'TEXT')
+
+
+def _migration_file_name_indexes(conn):
+    # Сверка с бакетом читает имена файлов в порядке ключей S3
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bouquets_file_name ON bouquets (file_name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_variants_file_name ON bouquet_variants (file_name)')
+
+
+def _migration_channel_posts(conn):
+    # Слот публикации (unix-время) -> букет; один букет публикуется один раз
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS channel_posts (
+            slot INTEGER PRIMARY KEY,
+            bouquet_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'planned',
+            message_id INTEGER,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_channel_posts_bouquet ON channel_posts (bouquet_id)')
+
+
+MIGRATIONS = [
+    (1, "букеты и генерации", _migration_initial),
+    (2, "очередь задач", _migration_jobs),
+    (3, "варианты изображений", _migration_variants),
+    (4, "хэш и палитра фото", _migration_image_features),
+    (5, "кэш file_id Telegram", _migration_tg_file_ids),
+    (6, "индексы каталога и истории", _migration_indexes),
+    (7, "полнотекстовый поиск", _migration_search),
+    (8, "состояние синхронизации с бакетом", _migration_sync_state),
+    (9, "индексы имён файлов", _migration_file_name_indexes),
+    (10, "публикации в канале", _migration_channel_posts),
+    (11, "пропуск слотов канала", _migration_channel_skipped),
+    (12, "результат задачи", _migration_job_result),
+]
+
 class Database:
-    def __init__(self, db_name="content_bot.db"):
+    """Доступ к SQLite из нескольких потоков.
+    
+    База работает в режиме WAL: чтения не ждут пишущую транзакцию, поэтому
+    просмотр каталога не блокируется массовой загрузкой или генерацией.
+    У каждого потока своё соединение (курсоры не разделяются), запись идёт
+    в явных транзакциях BEGIN IMMEDIATE, а несколько записей можно объединить
+    в одну через transaction(). Асинхронный код вызывает те же методы через
+    db.aio - они выполняются в пуле потоков и не блокируют event loop.
+    """
+    
+    def __init__(self, db_name="content_bot.db", workers=4, busy_timeout=5.0,
+                 mmap_size=256 * 1024 * 1024, cache_size_kib=32 * 1024, cache_entries=1024):
         self.db_name = db_name
-        self.conn = None
-        self.cursor = None
+        self.busy_timeout = busy_timeout
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+        # Горячие чтения: букет по id, число букетов, первая страница каталога
+        self.cache = RecordCache(cache_entries)
+        self.aio = AsyncDatabase(self)
         self.connect()
-        self.create_tables()
+        self.migrate()
         
     def connect(self):
+        """Соединение текущего потока (создаётся при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
         try:
-            self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-            self.cursor = self.conn.cursor()
-            logger.info("✅ Подключение к БД установлено")
+            # isolation_level=None: транзакции открываем сами, см. transaction()
+            conn = sqlite3.connect(
+                self.db_name, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            # В WAL synchronous=NORMAL не теряет целостность, только последние коммиты при сбое ОС
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kib)}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            self._local.conn = conn
+            self._local.depth = 0
+            self._local.pending_invalidations = []
+            with self._connections_lock:
+                self._connections.append(conn)
+            logger.info(f"✅ Подключение к БД установлено ({threading.current_thread().name})")
+            return conn
         except Exception as e:
             logger.error(f"❌ Ошибка подключения к БД: {e}")
+            raise
     
-    def create_tables(self):
-        try:
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS bouquets (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    file_id TEXT UNIQUE,
-                    photo_url TEXT,
-                    file_name TEXT,
-                    name TEXT DEFAULT "Букет",
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS generations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bouquet_id INTEGER,
-                    prompt TEXT,
-                    description TEXT,
-                    model TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (bouquet_id) REFERENCES bouquets (id)
+    @property
+    def conn(self):
+        return self.connect()
+    
+    @contextmanager
+    def transaction(self):
+        """Пишущая транзакция; вложенный вызов становится SAVEPOINT внутри внешней.
+        
+        BEGIN IMMEDIATE сразу берёт блокировку записи, поэтому параллельные
+        писатели ждут busy_timeout, а не получают ошибку посреди транзакции.
+        """
+        conn = self.conn
+        depth = self._local.depth
+        savepoint = f'sp{depth}'
+        conn.execute('BEGIN IMMEDIATE' if depth == 0 else f'SAVEPOINT {savepoint}')
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                conn.rollback()
+                self._local.pending_invalidations.clear()
+            else:
+                conn.execute(f'ROLLBACK TO {savepoint}')
+                conn.execute(f'RELEASE {savepoint}')
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            conn.commit()
+            # Кэш сбрасываем только после коммита, иначе его заполнят старыми данными
+            pending, self._local.pending_invalidations = self._local.pending_invalidations, []
+            for bouquet_ids, catalog in pending:
+                self._invalidate(bouquet_ids, catalog)
+        else:
+            conn.execute(f'RELEASE {savepoint}')
+    
+    def _invalidate(self, bouquet_ids=(), catalog=False):
+        """Сбрасывает кэш после записи: букеты bouquet_ids и первые страницы с ними.
+        
+        catalog=True - изменился состав каталога: сбрасываются счётчик и все первые страницы.
+        """
+        if self._local.depth:
+            self._local.pending_invalidations.append((tuple(bouquet_ids), catalog))
+            return
+        ids = set(bouquet_ids)
+        
+        def stale_page(key, value):
+            return key[0] == 'first_page' and (catalog or any(bouquet.id in ids for bouquet in value[0]))
+        
+        keys = [('bouquet', bouquet_id) for bouquet_id in ids]
+        if catalog:
+            keys.append(('count',))
+        self.cache.invalidate(keys, stale_page)
+    
+    def _write(self, sql, params=()):
+        """Одна пишущая команда в своей (или текущей) транзакции"""
+        with self.transaction() as conn:
+            return conn.execute(sql, params)
+    
+    def migrate(self):
+        """Доводит схему до последней версии из MIGRATIONS.
+        
+        Номер применённой версии хранится в PRAGMA user_version; каждая
+        миграция выполняется в своей транзакции вместе с записью номера.
+        """
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, title, migration in MIGRATIONS:
+            if number <= version:
+                continue
+            with self.transaction() as conn:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+            logger.info(f"✅ Миграция {number}: {title}")
+        logger.info(f"✅ Схема БД актуальна (версия {max(version, MIGRATIONS[-1][0])})")
+    
+    def add_bouquet(self, file_id, photo_url, file_name, phash=None, palette=None):
+        try:
+            cursor = self._write(
+                'INSERT OR IGNORE INTO bouquets (file_id, photo_url, file_name, phash, palette) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (file_id, photo_url, file_name, phash, palette)
+            )
+            if cursor.rowcount:
+                self._invalidate(catalog=True)
+            if cursor.rowcount == 0:
+                # Такой file_id уже есть - возвращаем существующую запись
+                cursor = self.conn.execute('SELECT id FROM bouquets WHERE file_id = ?', (file_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"Ошибка добавления букета: {e}")
+            return None
+    
+    def add_bouquets_batch(self, rows):
+        """Добавляет пачку (file_id, photo_url, file_name, phash, palette) одной транзакцией.
+        
+        Возвращает {file_id: id}, включая уже существовавшие записи.
+        """
+        try:
+            with self.transaction() as conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO bouquets (file_id, photo_url, file_name, phash, palette) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    rows
                 )
-            ''')
-            
-            self.conn.commit()
-            logger.info("✅ Таблицы созданы")
+            self._invalidate(catalog=True)
+            file_ids = [row[0] for row in rows]
+            placeholders = ','.join('?' * len(file_ids))
+            cursor = self.conn.execute(
+                f'SELECT file_id, id FROM bouquets WHERE file_id IN ({placeholders})', file_ids
+            )
+            return dict(cursor.fetchall())
         except Exception as e:
-            logger.error(f"❌ Ошибка создания таблиц: {e}")
+            logger.error(f"Ошибка пакетного добавления букетов: {e}")
+            return {}
     
-    def add_bouquet(self, file_id, photo_url, file_name):
+    def add_bouquet_url(self, file_id, photo_url, file_name):
+        """Добавляет букет по объекту из облака; True, если запись новая"""
         try:
-            self.cursor.execute(
+            cursor = self._write(
                 'INSERT OR IGNORE INTO bouquets (file_id, photo_url, file_name) VALUES (?, ?, ?)',
                 (file_id, photo_url, file_name)
             )
-            self.conn.commit()
-            return self.cursor.lastrowid
+            if cursor.rowcount:
+                self._invalidate(catalog=True)
+            return cursor.rowcount > 0
         except Exception as e:
-            logger.error(f"Ошибка добавления букета: {e}")
+            logger.error(f"Ошибка добавления букета из облака: {e}")
+            return False
+    
+    def add_bouquet_urls(self, rows, prefix=None, watermark=None, batch_size=500, on_batch=None):
+        """Добавляет объекты из облака (file_id, photo_url, file_name) одной транзакцией.
+        
+        Строки пишутся executemany-пачками по batch_size, после каждой
+        вызывается on_batch(добавлено_всего). Объект, чей file_name уже есть
+        в базе (например, фото, загруженное через бота со своим file_id),
+        пропускается, поэтому повторный просмотр тех же ключей безвреден. Если передан watermark
+        (last_modified, etag), он сохраняется для prefix в той же транзакции.
+        Возвращает число новых букетов или None при ошибке.
+        """
+        try:
+            added = 0
+            with self.transaction() as conn:
+                for start in range(0, len(rows), batch_size):
+                    cursor = conn.executemany(
+                        'INSERT OR IGNORE INTO bouquets (file_id, photo_url, file_name) '
+                        'SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM bouquets WHERE file_name = ?)',
+                        [(file_id, url, file_name, file_name)
+                         for file_id, url, file_name in rows[start:start + batch_size]]
+                    )
+                    added += max(cursor.rowcount, 0)
+                    if on_batch is not None:
+                        on_batch(added)
+                if prefix is not None and watermark is not None:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO sync_state (prefix, last_modified, etag, updated_at) '
+                        'VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
+                        (prefix, watermark[0], watermark[1])
+                    )
+                if added:
+                    self._invalidate(catalog=True)
+            return added
+        except Exception as e:
+            logger.error(f"Ошибка пакетного добавления букетов из облака: {e}")
             return None
     
-    def get_bouquet(self, bouquet_id):
+    def get_sync_state(self, prefix):
+        """Водяной знак (last_modified, etag) прошлой синхронизации префикса или None"""
         try:
-            self.cursor.execute('SELECT * FROM bouquets WHERE id = ?', (bouquet_id,))
-            row = self.cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'file_id': row[1],
-                    'photo_url': row[2],
-                    'file_name': row[3],
-                    'name': row[4],
-                    'description': row[5],
-                    'created_at': row[6]
-                }
+            row = self.conn.execute(
+                'SELECT last_modified, etag FROM sync_state WHERE prefix = ?', (prefix,)
+            ).fetchone()
+            return tuple(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка чтения состояния синхронизации: {e}")
             return None
+    
+    def get_bouquet(self, bouquet_id):
+        hit, bouquet = self.cache.get(('bouquet', bouquet_id))
+        if hit:
+            return bouquet
+        try:
+            version = self.cache.version
+            row = self.conn.execute(
+                f'SELECT {BOUQUET_COLUMNS} FROM bouquets WHERE id = ?', (bouquet_id,)
+            ).fetchone()
+            if not row:
+                return None
+            bouquet = Bouquet._make(row)
+            self.cache.put(('bouquet', bouquet_id), bouquet, version)
+            return bouquet
         except Exception as e:
             logger.error(f"Ошибка получения букета: {e}")
             return None
     
-    def get_all_bouquets(self):
+    def get_bouquets_by_ids(self, bouquet_ids):
+        """Букеты в порядке переданных id"""
         try:
-            self.cursor.execute('SELECT id, photo_url, name, description FROM bouquets ORDER BY created_at DESC')
-            rows = self.cursor.fetchall()
-            bouquets = []
-            for row in rows:
-                bouquets.append({
-                    'id': row[0],
-                    'photo_url': row[1],
-                    'name': row[2],
-                    'description': row[3]
-                })
-            return bouquets
+            bouquet_ids = list(bouquet_ids)
+            if not bouquet_ids:
+                return []
+            placeholders = ','.join('?' * len(bouquet_ids))
+            cursor = self.conn.execute(
+                f'SELECT {BOUQUET_COLUMNS} FROM bouquets WHERE id IN ({placeholders})', bouquet_ids
+            )
+            found = {bouquet.id: bouquet for bouquet in map(Bouquet._make, cursor)}
+            return [found[bouquet_id] for bouquet_id in bouquet_ids if bouquet_id in found]
         except Exception as e:
             logger.error(f"Ошибка получения букетов: {e}")
             return []
     
+    def get_bouquet_ids_by_file_ids(self, file_ids):
+        """{file_id: id} для уже сохранённых фото из переданных"""
+        try:
+            file_ids = list(file_ids)
+            if not file_ids:
+                return {}
+            placeholders = ','.join('?' * len(file_ids))
+            cursor = self.conn.execute(
+                f'SELECT file_id, id FROM bouquets WHERE file_id IN ({placeholders})', file_ids
+            )
+            return dict(cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Ошибка поиска букетов по file_id: {e}")
+            return {}
+    
+    def get_bouquets_count(self):
+        hit, count = self.cache.get(('count',))
+        if hit:
+            return count
+        try:
+            version = self.cache.version
+            count = self.conn.execute('SELECT COUNT(*) FROM bouquets').fetchone()[0]
+            self.cache.put(('count',), count, version)
+            return count
+        except Exception as e:
+            logger.error(f"Ошибка подсчёта букетов: {e}")
+            return 0
+    
+    def get_bouquets_page(self, limit, cursor=None, backward=False):
+        """Страница каталога от новых к старым (keyset-пагинация по (created_at, id)).
+        
+        cursor - (unix-время, id) крайнего букета соседней страницы: без него
+        возвращается первая страница, с backward=False - букеты старше курсора,
+        с backward=True - новее. Возвращает (букеты, есть_ли_ещё_в_этом_направлении);
+        курсор букета - (bouquet.created_ts, bouquet.id).
+        """
+        # Первую страницу открывают чаще всего - она кэшируется
+        first_page = cursor is None
+        if first_page:
+            hit, page = self.cache.get(('first_page', limit))
+            if hit:
+                return list(page[0]), page[1]
+        try:
+            version = self.cache.version
+            if first_page:
+                result = self.conn.execute(
+                    f'SELECT {BOUQUET_COLUMNS} FROM bouquets ORDER BY created_at DESC, id DESC LIMIT ?',
+                    (limit + 1,)
+                )
+            elif backward:
+                result = self.conn.execute(
+                    f'SELECT {BOUQUET_COLUMNS} FROM bouquets '
+                    "WHERE (created_at, id) > (datetime(?, 'unixepoch'), ?) "
+                    'ORDER BY created_at, id LIMIT ?',
+                    (cursor[0], cursor[1], limit + 1)
+                )
+            else:
+                result = self.conn.execute(
+                    f'SELECT {BOUQUET_COLUMNS} FROM bouquets '
+                    "WHERE (created_at, id) < (datetime(?, 'unixepoch'), ?) "
+                    'ORDER BY created_at DESC, id DESC LIMIT ?',
+                    (cursor[0], cursor[1], limit + 1)
+                )
+            bouquets = list(map(Bouquet._make, result))
+            has_more = len(bouquets) > limit
+            bouquets = bouquets[:limit]
+            if backward:
+                bouquets.reverse()
+            if first_page:
+                self.cache.put(('first_page', limit), (tuple(bouquets), has_more), version)
+            return bouquets, has_more
+        except Exception as e:
+            logger.error(f"Ошибка получения страницы букетов: {e}")
+            return [], False
+    
+    def get_bouquets_without_description(self):
+        try:
+            cursor = self.conn.execute(
+                f'SELECT {BOUQUET_COLUMNS} FROM bouquets '
+                "WHERE description IS NULL OR description = '' ORDER BY id"
+            )
+            return list(map(Bouquet._make, cursor))
+        except Exception as e:
+            logger.error(f"Ошибка получения букетов без описания: {e}")
+            return []
+    
     def update_description(self, bouquet_id, description):
         try:
-            self.cursor.execute(
+            self._write(
                 'UPDATE bouquets SET description = ? WHERE id = ?',
                 (description, bouquet_id)
             )
-            self.conn.commit()
+            self._invalidate([bouquet_id])
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления описания: {e}")
@@ -113,17 +639,512 @@ class Database:
     
     def add_generation(self, bouquet_id, prompt, description, model="yandexgpt"):
         try:
-            self.cursor.execute(
+            self._write(
                 'INSERT INTO generations (bouquet_id, prompt, description, model) VALUES (?, ?, ?, ?)',
                 (bouquet_id, prompt, description, model)
             )
-            self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Ошибка сохранения генерации: {e}")
             return False
     
+    def save_generations_batch(self, items, model="yandexgpt"):
+        """Сохраняет пачку (bouquet_id, prompt, description) одной транзакцией"""
+        try:
+            with self.transaction() as conn:
+                conn.executemany(
+                    'UPDATE bouquets SET description = ? WHERE id = ?',
+                    [(description, bouquet_id) for bouquet_id, prompt, description in items]
+                )
+                conn.executemany(
+                    'INSERT INTO generations (bouquet_id, prompt, description, model) VALUES (?, ?, ?, ?)',
+                    [(bouquet_id, prompt, description, model) for bouquet_id, prompt, description in items]
+                )
+                self._invalidate([bouquet_id for bouquet_id, _, _ in items])
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка пакетного сохранения генераций: {e}")
+            return False
+    
+    # --- Признаки изображений (хэш, палитра) ---
+    
+    def set_image_features(self, bouquet_id, phash, palette):
+        try:
+            self._write(
+                'UPDATE bouquets SET phash = ?, palette = ? WHERE id = ?', (phash, palette, bouquet_id)
+            )
+            self._invalidate([bouquet_id])
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения признаков изображения: {e}")
+            return False
+    
+    def get_phashes(self):
+        """Все пары (id, phash) для построения индекса дубликатов"""
+        try:
+            cursor = self.conn.execute('SELECT id, phash FROM bouquets WHERE phash IS NOT NULL')
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка получения хэшей: {e}")
+            return []
+    
+    def get_palettes(self):
+        """Все пары (id, palette) для построения цветового индекса"""
+        try:
+            cursor = self.conn.execute('SELECT id, palette FROM bouquets WHERE palette IS NOT NULL')
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка получения палитр: {e}")
+            return []
+    
+    def get_bouquets_without_features(self):
+        try:
+            cursor = self.conn.execute(
+                f'SELECT {BOUQUET_COLUMNS} FROM bouquets WHERE phash IS NULL OR palette IS NULL ORDER BY id'
+            )
+            return list(map(Bouquet._make, cursor))
+        except Exception as e:
+            logger.error(f"Ошибка получения букетов без признаков: {e}")
+            return []
+    
+    # --- Варианты изображений ---
+    
+    def save_variants(self, bouquet_id, variants):
+        """Сохраняет варианты (dict с variant, file_name, photo_url, content_type, width, height, size)"""
+        try:
+            with self.transaction() as conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO bouquet_variants '
+                    '(bouquet_id, variant, file_name, photo_url, content_type, width, height, size) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [
+                        (bouquet_id, v['variant'], v['file_name'], v['photo_url'],
+                         v['content_type'], v['width'], v['height'], v['size'])
+                        for v in variants
+                    ]
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения вариантов: {e}")
+            return False
+    
+    def get_variants(self, bouquet_ids):
+        """Возвращает {bouquet_id: [Variant]} для списка букетов"""
+        try:
+            bouquet_ids = list(bouquet_ids)
+            if not bouquet_ids:
+                return {}
+            placeholders = ','.join('?' * len(bouquet_ids))
+            cursor = self.conn.execute(
+                f'SELECT {VARIANT_COLUMNS} FROM bouquet_variants WHERE bouquet_id IN ({placeholders})',
+                bouquet_ids
+            )
+            variants = {}
+            for variant in map(Variant._make, cursor):
+                variants.setdefault(variant.bouquet_id, []).append(variant)
+            return variants
+        except Exception as e:
+            logger.error(f"Ошибка получения вариантов: {e}")
+            return {}
+    
+    def set_tg_file_ids(self, items):
+        """Запоминает file_id отправленных фото: items - (bouquet_id, вариант или None, file_id).
+        
+        None вместо file_id сбрасывает кэш (например, если Telegram его отверг).
+        """
+        try:
+            items = list(items)
+            with self.transaction() as conn:
+                conn.executemany(
+                    'UPDATE bouquets SET tg_file_id = ? WHERE id = ?',
+                    [(file_id, bouquet_id) for bouquet_id, variant, file_id in items if variant is None]
+                )
+                conn.executemany(
+                    'UPDATE bouquet_variants SET tg_file_id = ? WHERE bouquet_id = ? AND variant = ?',
+                    [(file_id, bouquet_id, variant) for bouquet_id, variant, file_id in items if variant is not None]
+                )
+                self._invalidate([bouquet_id for bouquet_id, variant, _ in items if variant is None])
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения file_id: {e}")
+            return False
+    
+    # --- Сверка с бакетом ---
+    
+    def get_file_names_page(self, table, prefix, after=None, limit=1000):
+        """Страница (file_name, rowid) таблицы bouquets или bouquet_variants в порядке file_name.
+        
+        after - (file_name, rowid) последней строки предыдущей страницы.
+        Сравнение BINARY совпадает с порядком ключей в листинге S3.
+        """
+        if table not in ('bouquets', 'bouquet_variants'):
+            raise ValueError(f"Неизвестная таблица: {table}")
+        try:
+            # Диапазон вместо LIKE: префикс ищется по индексу
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else '\U0010ffff'
+            if after is None:
+                cursor = self.conn.execute(
+                    f'SELECT file_name, rowid FROM {table} WHERE file_name >= ? AND file_name < ? '
+                    'ORDER BY file_name, rowid LIMIT ?',
+                    (prefix, upper, limit)
+                )
+            else:
+                cursor = self.conn.execute(
+                    f'SELECT file_name, rowid FROM {table} WHERE (file_name, rowid) > (?, ?) AND file_name < ? '
+                    'ORDER BY file_name, rowid LIMIT ?',
+                    (after[0], after[1], upper, limit)
+                )
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка чтения имён файлов: {e}")
+            return None
+    
+    def delete_bouquets(self, bouquet_ids):
+        """Удаляет букеты вместе с вариантами и историей генераций"""
+        try:
+            params = [(bouquet_id,) for bouquet_id in bouquet_ids]
+            with self.transaction() as conn:
+                conn.executemany('DELETE FROM bouquet_variants WHERE bouquet_id = ?', params)
+                conn.executemany('DELETE FROM generations WHERE bouquet_id = ?', params)
+                cursor = conn.executemany('DELETE FROM bouquets WHERE id = ?', params)
+                self._invalidate([bouquet_id for bouquet_id, in params], catalog=True)
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка удаления букетов: {e}")
+            return 0
+    
+    def delete_variant_rows(self, rowids):
+        try:
+            with self.transaction() as conn:
+                cursor = conn.executemany(
+                    'DELETE FROM bouquet_variants WHERE rowid = ?', [(rowid,) for rowid in rowids]
+                )
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка удаления вариантов: {e}")
+            return 0
+    
+    # --- Публикации в канале ---
+    # planned -> ready -> posting -> posted; failed - окончательная ошибка,
+    # skipped - пост не подготовлен, букет можно поставить в другой слот.
+    # posting ставится до отправки, поэтому после падения процесса слот не
+    # публикуется повторно.
+    
+    def plan_channel_post(self, slot):
+        """Запись слота; если её нет - закрепляет за слотом следующий неопубликованный букет.
+        
+        Сначала берутся букеты с готовым описанием, затем самые старые.
+        Возвращает ChannelPost или None, если публиковать нечего.
+        """
+        try:
+            with self.transaction() as conn:
+                row = conn.execute(
+                    f'SELECT {CHANNEL_POST_COLUMNS} FROM channel_posts WHERE slot = ?', (slot,)
+                ).fetchone()
+                if row:
+                    return ChannelPost._make(row)
+                candidate = conn.execute(
+                    "SELECT id FROM bouquets WHERE id NOT IN "
+                    "(SELECT bouquet_id FROM channel_posts WHERE status != 'skipped') "
+                    'ORDER BY description IS NULL, created_at, id LIMIT 1'
+                ).fetchone()
+                if not candidate:
+                    return None
+                conn.execute(
+                    'INSERT INTO channel_posts (slot, bouquet_id) VALUES (?, ?)', (slot, candidate[0])
+                )
+            return ChannelPost(slot, candidate[0], 'planned', None, None)
+        except Exception as e:
+            logger.error(f"Ошибка планирования публикации: {e}")
+            return None
+    
+    def get_channel_post(self, slot):
+        try:
+            row = self.conn.execute(
+                f'SELECT {CHANNEL_POST_COLUMNS} FROM channel_posts WHERE slot = ?', (slot,)
+            ).fetchone()
+            return ChannelPost._make(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка чтения публикации: {e}")
+            return None
+    
+    def set_channel_post_status(self, slot, status, expected=None, message_id=None, error=None):
+        """Меняет статус слота; с expected - только из перечисленных статусов.
+        
+        Возвращает True, если запись изменена: так публикацию захватывает
+        ровно один вызов.
+        """
+        try:
+            sql = ('UPDATE channel_posts SET status = ?, message_id = COALESCE(?, message_id), error = ?, '
+                   'updated_at = CURRENT_TIMESTAMP WHERE slot = ?')
+            params = [status, message_id, error, slot]
+            if expected:
+                sql += f" AND status IN ({', '.join('?' * len(expected))})"
+                params += list(expected)
+            return self._write(sql, params).rowcount > 0
+        except Exception as e:
+            logger.error(f"Ошибка обновления публикации: {e}")
+            return False
+    
+    def abandon_channel_posts(self):
+        """Отправки, прерванные падением процесса, помечаются failed (возможен пропуск, но не дубль)"""
+        try:
+            return self._write(
+                "UPDATE channel_posts SET status = 'failed', error = 'прервано перезапуском', "
+                "updated_at = CURRENT_TIMESTAMP WHERE status = 'posting'"
+            ).rowcount
+        except Exception as e:
+            logger.error(f"Ошибка сброса прерванных публикаций: {e}")
+            return 0
+    
+    def get_channel_post_counts(self):
+        try:
+            rows = self.conn.execute('SELECT status, COUNT(*) FROM channel_posts GROUP BY status').fetchall()
+            return dict(rows)
+        except Exception as e:
+            logger.error(f"Ошибка статистики публикаций: {e}")
+            return {}
+    
+    # --- Полнотекстовый поиск ---
+    
+    def search_bouquets(self, query, limit=10):
+        """Букеты по словам из названия, описания и истории генераций.
+        
+        Возвращает SearchHit, лучшие по bm25 первыми; у каждого букета
+        остаётся одно, самое релевантное совпадение.
+        """
+        expression = _fts_query(query)
+        if not expression:
+            return []
+        try:
+            # Совпадения ищем с запасом: история может дать несколько строк на букет
+            rows = self.conn.execute(
+                "SELECT rowid, snippet(bouquets_fts, -1, '«', '»', '…', 12), rank, 'bouquet' "
+                'FROM bouquets_fts WHERE bouquets_fts MATCH ? ORDER BY rank LIMIT ?',
+                (expression, limit * 3)
+            ).fetchall()
+            rows += self.conn.execute(
+                "SELECT g.bouquet_id, snippet(generations_fts, 0, '«', '»', '…', 12), generations_fts.rank, "
+                "'generation' FROM generations_fts JOIN generations g ON g.id = generations_fts.rowid "
+                'WHERE generations_fts MATCH ? ORDER BY generations_fts.rank LIMIT ?',
+                (expression, limit * 3)
+            ).fetchall()
+            best = {}
+            for hit in map(SearchHit._make, rows):
+                # bm25 в FTS5 отрицательный: чем меньше, тем релевантнее
+                if hit.bouquet_id not in best or hit.score < best[hit.bouquet_id].score:
+                    best[hit.bouquet_id] = hit
+            return sorted(best.values(), key=lambda hit: hit.score)[:limit]
+        except Exception as e:
+            logger.error(f"Ошибка поиска: {e}")
+            return []
+    
+    def optimize_search_index(self, rebuild=False):
+        """Сливает сегменты FTS-индексов в один; rebuild=True строит их заново из таблиц"""
+        command = 'rebuild' if rebuild else 'optimize'
+        try:
+            with self.transaction() as conn:
+                for table in ('bouquets_fts', 'generations_fts'):
+                    conn.execute(f"INSERT INTO {table} ({table}) VALUES ('{command}')")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания поискового индекса: {e}")
+            return False
+    
+    # --- Очередь задач ---
+    
+    def enqueue_job(self, kind, payload, max_attempts=5, delay=0):
+        try:
+            cursor = self._write(
+                'INSERT INTO jobs (kind, payload, max_attempts, available_at) VALUES (?, ?, ?, ?)',
+                (kind, json.dumps(payload, ensure_ascii=False), max_attempts, time.time() + delay)
+            )
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"Ошибка постановки задачи: {e}")
+            return None
+    
+    def enqueue_missing_variants(self, max_attempts=5):
+        """Ставит задачу 'variants' букетам без вариантов, у которых её ещё не было.
+        
+        Нужна для букетов, добавленных мимо загрузки через бота (синхронизация
+        с облаком, сверка, sync_photos.py). Букеты с уже поставленной, в том
+        числе упавшей, задачей пропускаются. Возвращает число новых задач.
+        """
+        try:
+            cursor = self._write(
+                "INSERT INTO jobs (kind, payload, max_attempts, available_at) "
+                "SELECT 'variants', json_object('bouquet_id', b.id), ?, ? FROM bouquets b "
+                "WHERE NOT EXISTS (SELECT 1 FROM bouquet_variants v WHERE v.bouquet_id = b.id) "
+                "AND b.id NOT IN (SELECT json_extract(payload, '$.bouquet_id') FROM jobs "
+                "WHERE kind = 'variants' AND json_extract(payload, '$.bouquet_id') IS NOT NULL)",
+                (max_attempts, time.time())
+            )
+            return max(cursor.rowcount, 0)
+        except Exception as e:
+            logger.error(f"Ошибка постановки задач вариантов: {e}")
+            return 0
+    
+    def claim_job(self, kind, lease_seconds):
+        """Захватывает готовую задачу (или задачу с истёкшей арендой) на lease_seconds"""
+        try:
+            now = time.time()
+            with self.transaction() as conn:
+                # Задачи, исчерпавшие попытки в упавшем процессе, больше не берём
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', updated_at = CURRENT_TIMESTAMP "
+                    "WHERE kind = ? AND status = 'running' AND lease_until < ? AND attempts >= max_attempts",
+                    (kind, now)
+                )
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE kind = ? AND "
+                    "((status = 'pending' AND available_at <= ?) OR (status = 'running' AND lease_until < ?)) "
+                    "ORDER BY available_at, id LIMIT 1",
+                    (kind, now, now)
+                ).fetchone()
+                if not row:
+                    return None
+                
+                # Выборка и захват в одной IMMEDIATE-транзакции, второй воркер задачу не получит
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, "
+                    "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (now + lease_seconds, row[0])
+                )
+                job = conn.execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?', (row[0],)).fetchone()
+            return _job(job)
+        except Exception as e:
+            logger.error(f"Ошибка захвата задачи: {e}")
+            return None
+    
+    def get_job(self, job_id):
+        try:
+            row = self.conn.execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return _job(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка получения задачи: {e}")
+            return None
+    
+    def extend_job_lease(self, job_id, lease_seconds):
+        try:
+            self._write(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                (time.time() + lease_seconds, job_id)
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка продления аренды задачи: {e}")
+            return False
+    
+    def ack_job(self, job_id, result=None):
+        """Отмечает задачу выполненной; result (JSON-совместимый) сохраняется вместе с ней"""
+        try:
+            self._write(
+                "UPDATE jobs SET status = 'done', lease_until = NULL, result = ?, updated_at = CURRENT_TIMESTAMP "
+                "WHERE id = ?",
+                (json.dumps(result, ensure_ascii=False) if result is not None else None, job_id)
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка подтверждения задачи: {e}")
+            return False
+    
+    def fail_job(self, job_id, error, retry_delay):
+        """Возвращает задачу в очередь через retry_delay секунд.
+        
+        Возвращает True, если попытки исчерпаны и задача помечена failed.
+        """
+        try:
+            cursor = self._write(
+                "UPDATE jobs SET "
+                "status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+                "available_at = ?, lease_until = NULL, last_error = ?, updated_at = CURRENT_TIMESTAMP "
+                "WHERE id = ?",
+                (time.time() + retry_delay, str(error)[:500], job_id)
+            )
+            cursor = self.conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            return bool(row) and row[0] == 'failed'
+        except Exception as e:
+            logger.error(f"Ошибка возврата задачи в очередь: {e}")
+            return False
+    
+    def release_running_jobs(self):
+        """Снимает аренду с задач, оставшихся от прошлого запуска процесса"""
+        try:
+            cursor = self._write(
+                "UPDATE jobs SET "
+                "status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+                "lease_until = NULL, available_at = ? WHERE status = 'running'",
+                (time.time(),)
+            )
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка восстановления задач: {e}")
+            return 0
+    
+    def get_job_counts(self):
+        try:
+            cursor = self.conn.execute('SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status')
+            counts = {}
+            for kind, status, count in cursor.fetchall():
+                counts.setdefault(kind, {})[status] = count
+            return counts
+        except Exception as e:
+            logger.error(f"Ошибка подсчёта задач: {e}")
+            return {}
+    
     def close(self):
-        if self.conn:
-            self.conn.close()
-            logger.info("✅ Соединение с БД закрыто")
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+        logger.info("✅ Соединение с БД закрыто")
+
+
+SQLITE_QUERY_SECONDS = Histogram(
+    'sqlite_query_duration_seconds', 'Время выполнения методов базы в потоке БД', ['method']
+)
+
+
+def _timed_call(seconds, method, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return method(*args, **kwargs)
+    finally:
+        seconds.observe(time.perf_counter() - started)
+
+
+class AsyncDatabase:
+    """Асинхронный фасад: db.aio.get_bouquet(1) выполняет db.get_bouquet(1) в пуле потоков БД.
+    
+    Обёртка для каждого метода создаётся один раз вместе со своей серией
+    sqlite_query_duration_seconds и дальше берётся из словаря.
+    """
+    
+    def __init__(self, db):
+        self._db = db
+        self._calls = {}
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполняет произвольную функцию в потоке БД (например, пачку записей в db.transaction())"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db._executor, partial(func, *args, **kwargs))
+    
+    def __getattr__(self, name):
+        call = self._calls.get(name)
+        if call is not None:
+            return call
+        method = getattr(self._db, name)
+        if not callable(method):
+            raise AttributeError(name)
+        seconds = SQLITE_QUERY_SECONDS.labels(name)
+        
+        async def call(*args, **kwargs):
+            return await self.run(_timed_call, seconds, method, *args, **kwargs)
+        
+        call.__name__ = name
+        self._calls[name] = call
+        return call
@@ -0,0 +1,109 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+HASH_MASK = (1 << 64) - 1
+
+
+def to_signed(value: int) -> int:
+    """64-битный хэш -> знаковое число для INTEGER-колонки SQLite"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value: int) -> int:
+    return value & HASH_MASK
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def low_detail(value: int, min_bits: int) -> bool:
+    """Хэш почти из одних нулей или единиц: так выглядят однотонные и размытые фото.
+
+    У таких хэшей малое расстояние Хэмминга ещё не значит, что фото похожи.
+    """
+    bits = to_unsigned(value).bit_count()
+    return min(bits, 64 - bits) < min_bits
+
+
+class BKTree:
+    """BK-дерево по расстоянию Хэмминга: поиск соседей в радиусе k
+    просматривает только ветви, допустимые неравенством треугольника.
+    """
+
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, value: int, item) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = (value, [item], {})
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> list:
+        """Список (расстояние, item) в радиусе radius, ближайшие первыми"""
+        if self._root is None:
+            return []
+        found = []
+        stack = [self._root]
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= radius:
+                found.extend((distance, item) for item in items)
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class PhashIndex:
+    """Индекс перцептивных хэшей букетов для поиска почти-дубликатов"""
+
+    def __init__(self):
+        self._tree = BKTree()
+        self._removed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._tree.size - len(self._removed)
+
+    def load(self, rows) -> None:
+        """rows - пары (bouquet_id, phash) из базы"""
+        with self._lock:
+            for bouquet_id, phash in rows:
+                self._tree.add(to_unsigned(phash), bouquet_id)
+        logger.info(f"✅ Индекс хэшей загружен: {len(self)} букетов")
+
+    def add(self, phash: int, bouquet_id: int) -> None:
+        with self._lock:
+            self._removed.discard(bouquet_id)
+            self._tree.add(to_unsigned(phash), bouquet_id)
+
+    def discard(self, bouquet_id: int) -> None:
+        with self._lock:
+            self._removed.add(bouquet_id)
+
+    def query(self, phash: int, radius: int, exclude=None) -> list:
+        """Список (расстояние, bouquet_id) почти-дубликатов"""
+        with self._lock:
+            matches = self._tree.search(to_unsigned(phash), radius)
+        return [
+            (distance, bouquet_id) for distance, bouquet_id in matches
+            if bouquet_id not in self._removed and bouquet_id != exclude
+        ]
@@ -0,0 +1,173 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Варианты изображения: максимальная сторона (None - без уменьшения) и формат
+VARIANTS = {
+    'thumb': {'max_side': 320, 'format': 'JPEG', 'quality': 80},
+    'post': {'max_side': 1280, 'format': 'JPEG', 'quality': 85},
+    'optimized': {'max_side': None, 'format': 'JPEG', 'quality': 85},
+    'webp': {'max_side': None, 'format': 'WEBP', 'quality': 80},
+}
+
+CONTENT_TYPES = {'JPEG': ('image/jpeg', 'jpg'), 'WEBP': ('image/webp', 'webp')}
+
+# Форматы, которые Telegram принимает как фото
+TELEGRAM_PHOTO_TYPES = ('image/jpeg',)
+
+
+def build_variants(data: bytes) -> list:
+    """Строит все варианты изображения. Выполняется в отдельном процессе."""
+    source = Image.open(io.BytesIO(data))
+    source = ImageOps.exif_transpose(source).convert('RGB')
+
+    variants = []
+    for name, spec in VARIANTS.items():
+        image = source.copy()
+        if spec['max_side']:
+            image.thumbnail((spec['max_side'], spec['max_side']), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        if spec['format'] == 'JPEG':
+            image.save(buffer, 'JPEG', quality=spec['quality'], optimize=True, progressive=True)
+        else:
+            image.save(buffer, spec['format'], quality=spec['quality'], method=4)
+
+        content_type, extension = CONTENT_TYPES[spec['format']]
+        variants.append({
+            'variant': name,
+            'body': buffer.getvalue(),
+            'width': image.width,
+            'height': image.height,
+            'content_type': content_type,
+            'extension': extension,
+        })
+    return variants
+
+
+# Цветовая гистограмма: PALETTE_BINS корзин на канал RGB
+PALETTE_BINS = 4
+PALETTE_SIZE = PALETTE_BINS ** 3
+
+# Названия цветов для описания палитры в промпте
+COLOR_NAMES = [
+    ('белый', (245, 245, 240)),
+    ('кремовый', (240, 225, 190)),
+    ('розовый', (240, 150, 180)),
+    ('нежно-розовый', (245, 200, 210)),
+    ('красный', (200, 30, 40)),
+    ('бордовый', (110, 20, 40)),
+    ('оранжевый', (240, 130, 40)),
+    ('жёлтый', (240, 210, 60)),
+    ('зелёный', (70, 130, 60)),
+    ('голубой', (130, 190, 230)),
+    ('синий', (40, 60, 160)),
+    ('фиолетовый', (110, 50, 140)),
+    ('сиреневый', (190, 150, 210)),
+    ('коричневый', (120, 80, 50)),
+    ('серый', (128, 128, 128)),
+    ('чёрный', (20, 20, 20)),
+]
+
+
+def _dhash_image(image) -> int:
+    """64-битный разностный хэш (dHash): устойчив к масштабу и перекодированию"""
+    image = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def color_histogram(image) -> np.ndarray:
+    """Доли пикселей по корзинам RGB (float32, сумма = 1)"""
+    pixels = np.asarray(image.convert('RGB').resize((64, 64)), dtype=np.uint8).reshape(-1, 3)
+    bins = (pixels // (256 // PALETTE_BINS)).astype(np.int32)
+    index = bins[:, 0] * PALETTE_BINS * PALETTE_BINS + bins[:, 1] * PALETTE_BINS + bins[:, 2]
+    histogram = np.bincount(index, minlength=PALETTE_SIZE).astype(np.float32)
+    return histogram / histogram.sum()
+
+
+def analyze(data: bytes):
+    """(dHash, палитра в виде float32-блоба) по байтам изображения. Выполняется в отдельном процессе."""
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    return _dhash_image(image), color_histogram(image).tobytes()
+
+
+def _bin_names():
+    step = 256 // PALETTE_BINS
+    centers = np.array([
+        (r * step + step // 2, g * step + step // 2, b * step + step // 2)
+        for r in range(PALETTE_BINS) for g in range(PALETTE_BINS) for b in range(PALETTE_BINS)
+    ], dtype=np.float32)
+    references = np.array([rgb for _, rgb in COLOR_NAMES], dtype=np.float32)
+    distances = ((centers[:, None, :] - references[None, :, :]) ** 2).sum(axis=2)
+    return distances.argmin(axis=1)
+
+
+# Для каждой корзины гистограммы - индекс ближайшего названия цвета
+BIN_NAMES = _bin_names()
+
+
+def palette_names(palette: bytes, top: int = 3, min_share: float = 0.08) -> list:
+    """Основные цвета палитры по-русски, от преобладающего"""
+    histogram = np.frombuffer(palette, dtype=np.float32)
+    shares = np.bincount(BIN_NAMES, weights=histogram, minlength=len(COLOR_NAMES))
+    order = np.argsort(shares)[::-1][:top]
+    return [COLOR_NAMES[i][0] for i in order if shares[i] >= min_share]
+
+
+def pick_variant(variants, min_side: int, content_types=TELEGRAM_PHOTO_TYPES):
+    """Самый лёгкий вариант, у которого большая сторона не меньше min_side.
+
+    Если подходящего нет, возвращается самый крупный из доступных.
+    """
+    candidates = [v for v in variants if v.content_type in content_types]
+    if not candidates:
+        return None
+    fitting = [v for v in candidates if max(v.width, v.height) >= min_side]
+    if fitting:
+        return min(fitting, key=lambda v: v.size)
+    return max(candidates, key=lambda v: max(v.width, v.height))
+
+
+class ImageProcessor:
+    """Пул процессов для обработки изображений, чтобы не блокировать event loop"""
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self._pool = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: дочерние процессы не наследуют потоки и соединения бота
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._pool
+
+    async def build_variants(self, data: bytes) -> list:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(), build_variants, data)
+
+    async def analyze(self, data: bytes):
+        """(dHash, палитра) по байтам изображения"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(), analyze, data)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import mimetypes
+import os
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramFileStream:
+    """Потоковое чтение файлов Telegram чанками через общий пул соединений"""
+
+    def __init__(self):
+        self.chunk_size = int(os.getenv("TELEGRAM_CHUNK_SIZE", str(256 * 1024)))
+        self.timeout = httpx.Timeout(float(os.getenv("TELEGRAM_DOWNLOAD_TIMEOUT", "60")), connect=10)
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    async def iter_chunks(self, file):
+        """Отдаёт содержимое telegram.File по мере скачивания, не собирая его целиком"""
+        # В PTB 20 file_path уже содержит полный URL для скачивания
+        async with self._get_client().stream("GET", file.file_path) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                yield chunk
+
+    async def download(self, file) -> bytes:
+        """Скачивает небольшой файл (превью) целиком"""
+        buffer = bytearray()
+        async for chunk in self.iter_chunks(file):
+            buffer += chunk
+        return bytes(buffer)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def describe_media(message):
+    """Возвращает (файл, превью или None, content_type, расширение) для фото или изображения-документа.
+
+    Превью - самый маленький размер фото (или миниатюра документа): его
+    достаточно для перцептивного хэша до загрузки оригинала.
+    """
+    if message.photo:
+        return message.photo[-1], message.photo[0], 'image/jpeg', 'jpg'
+    document = message.document
+    content_type = document.mime_type or 'image/jpeg'
+    extension = (mimetypes.guess_extension(content_type) or '.jpg').lstrip('.')
+    return document, document.thumbnail, content_type, extension
+
+
+class MediaGroupCollector:
+    """Собирает апдейты одного альбома (media_group_id) в одну пачку.
+
+    Telegram присылает фото альбома отдельными апдейтами без признака
+    последнего, поэтому пачка закрывается, когда delay секунд не приходит
+    новых фото, и передаётся в on_complete(key, items).
+    """
+
+    def __init__(self, delay, on_complete):
+        self.delay = delay
+        self.on_complete = on_complete
+        self._items = {}
+        self._timers = {}
+
+    def add(self, key, item):
+        self._items.setdefault(key, []).append(item)
+        timer = self._timers.get(key)
+        if timer is not None:
+            timer.cancel()
+        self._timers[key] = asyncio.create_task(self._flush_later(key))
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.delay)
+        items = self._items.pop(key, [])
+        self._timers.pop(key, None)
+        if items:
+            try:
+                await self.on_complete(key, items)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки альбома: {e}")
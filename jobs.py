@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from concurrency import backoff_delay
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+JOB_SECONDS = Histogram('job_duration_seconds', 'Время выполнения фоновых задач', ['kind'])
+JOB_FAILURES = Counter('job_failures_total', 'Попытки фоновых задач, завершившиеся ошибкой', ['kind'])
+# Полная задержка, которую видит пользователь: от постановки в очередь до
+# успешного завершения, вместе с ожиданием воркера и повторными попытками
+JOB_LATENCY = Histogram('job_latency_seconds', 'Время от постановки фоновой задачи до её завершения', ['kind'],
+                        buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0))
+
+JobHandler = Callable[[Any, dict], Awaitable[Any]]
+
+
+class JobWorkers:
+    """Фоновые воркеры для очереди задач из таблицы jobs.
+
+    Обработчик задачи вызывается как handler(bot, job), где job - запись
+    database.Job (id, kind, payload, status, attempts, max_attempts, result).
+    Значение, которое вернул обработчик, сохраняется в result задачи.
+    enqueue() добавляет в payload служебное поле _enqueued_at (unix-время)
+    для метрики job_latency_seconds.
+    Исключение в обработчике возвращает задачу в очередь с задержкой;
+    после max_attempts вызывается on_failure.
+    """
+
+    def __init__(self, db, lease_seconds=120, poll_interval=5.0, max_attempts=5):
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._handlers: Dict[str, tuple] = {}
+        self._wakeups: Dict[str, asyncio.Event] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._metrics: Dict[str, tuple] = {}
+        self.bot = None
+
+    def register(self, kind: str, handler: JobHandler, workers: int = 1,
+                 on_failure: Optional[Callable[[Any, dict, Exception], Awaitable[None]]] = None):
+        self._handlers[kind] = (handler, workers, on_failure)
+
+    async def enqueue(self, kind: str, payload: dict) -> Optional[int]:
+        """Сохраняет задачу в базу и будит воркеры этого типа"""
+        # Перезаписываем, а не сохраняем: повторная постановка (force) - новая задача
+        payload = dict(payload, _enqueued_at=time.time())
+        job_id = await self.db.aio.enqueue_job(kind, payload, max_attempts=self.max_attempts)
+        if job_id and kind in self._wakeups:
+            self._wakeups[kind].set()
+        return job_id
+
+    async def start(self, bot):
+        self.bot = bot
+        # Задачи, прерванные прошлым запуском, снова становятся доступны
+        released = await self.db.aio.release_running_jobs()
+        if released:
+            logger.info(f"♻️ Возобновлено незавершённых задач: {released}")
+        for kind, (handler, workers, on_failure) in self._handlers.items():
+            self._wakeups[kind] = asyncio.Event()
+            self._metrics[kind] = (JOB_SECONDS.labels(kind), JOB_FAILURES.labels(kind), JOB_LATENCY.labels(kind))
+            for _ in range(workers):
+                self._tasks.append(asyncio.create_task(self._worker(kind, handler, on_failure)))
+        logger.info(f"✅ Запущено воркеров задач: {len(self._tasks)}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self.db.aio.extend_job_lease(job_id, self.lease_seconds)
+
+    async def _worker(self, kind: str, handler: JobHandler, on_failure):
+        wakeup = self._wakeups[kind]
+        seconds, failures, latency = self._metrics[kind]
+        while True:
+            # Сбрасываем до захвата, чтобы не потерять сигнал от enqueue
+            wakeup.clear()
+            job = await self.db.aio.claim_job(kind, self.lease_seconds)
+            if job is None:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heartbeat = asyncio.create_task(self._heartbeat(job.id))
+            started = time.perf_counter()
+            try:
+                result = await handler(self.bot, job)
+            except asyncio.CancelledError:
+                # Остановка процесса: аренда истечёт, задачу подхватят после рестарта
+                raise
+            except Exception as e:
+                failures.inc()
+                delay = backoff_delay(job.attempts, base=2.0, cap=300.0)
+                logger.error(f"❌ Задача {kind}#{job.id} (попытка {job.attempts}): {e}")
+                if await self.db.aio.fail_job(job.id, e, delay) and on_failure is not None:
+                    try:
+                        await on_failure(self.bot, job, e)
+                    except Exception as hook_error:
+                        logger.error(f"Ошибка обработчика отказа задачи: {hook_error}")
+            else:
+                await self.db.aio.ack_job(job.id, result)
+                enqueued_at = job.payload.get('_enqueued_at')
+                if enqueued_at is not None:
+                    latency.observe(max(0.0, time.time() - enqueued_at))
+            finally:
+                seconds.observe(time.perf_counter() - started)
+                heartbeat.cancel()
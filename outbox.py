@@ -0,0 +1,239 @@
+import asyncio
+import itertools
+import logging
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from concurrency import LatencyTracker, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений: меньше - важнее
+INTERACTIVE = 0
+BULK = 1
+CHANNEL = 2
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk', CHANNEL: 'channel'}
+
+# Методы, которые Telegram ограничивает по частоте в чате
+QUEUED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+# Правки одного сообщения, которые можно схлопнуть в последнюю
+COALESCED_ENDPOINTS = {'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup'}
+
+
+class _Outgoing:
+    __slots__ = ('priority', 'seq', 'chat_id', 'cost', 'key', 'callback', 'args', 'kwargs',
+                 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, priority, seq, chat_id, cost, key, callback, args, kwargs, future, enqueued_at):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.cost = cost
+        self.key = key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+
+
+class OutboxRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """Единая очередь исходящих запросов к Telegram.
+
+    Подключается через ApplicationBuilder().rate_limiter(), поэтому через
+    неё проходят все отправки и правки бота. Запрос уходит, когда есть
+    токены в общем бакете и в бакете чата (группам и каналам - свой
+    лимит); из готовых первым идёт запрос с меньшим приоритетом, при
+    равном - более ранний. Приоритет задаётся при вызове:
+    bot.send_message(..., rate_limit_args={'priority': BULK}).
+
+    Повторные правки ещё не отправленного сообщения заменяют предыдущую,
+    а RetryAfter приостанавливает очередь на указанное время и ставит
+    запрос обратно.
+
+    stats() можно вызывать из другого потока (сервер метрик): очередь
+    читает только цикл событий, он же после каждого прохода публикует
+    готовый снимок её глубины.
+    """
+
+    def __init__(self, global_rate=25.0, chat_rate=1.0, group_rate=20 / 60, chat_burst=3, max_retries=3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._queue = []
+        self._pending_edits: Dict[tuple, _Outgoing] = {}
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._in_flight = set()
+        self._waits = LatencyTracker(window=500)
+        self._depth_by_priority = self._count_by_priority()
+        self.sent = 0
+        self.coalesced = 0
+        self.retry_after = 0
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for entry in self._queue:
+            entry.future.cancel()
+        self._queue.clear()
+        self._pending_edits.clear()
+        self._depth_by_priority = self._count_by_priority()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ):
+        chat_id = data.get('chat_id')
+        if self._dispatcher is None or chat_id is None or not endpoint.startswith(QUEUED_PREFIXES):
+            return await callback(*args, **kwargs)
+
+        priority = (rate_limit_args or {}).get('priority', INTERACTIVE)
+        key = None
+        if endpoint in COALESCED_ENDPOINTS and data.get('message_id') is not None:
+            key = (endpoint, chat_id, data['message_id'])
+            pending = self._pending_edits.get(key)
+            if pending is not None:
+                # Предыдущая правка ещё в очереди - отправим только последнюю
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                pending.priority = min(pending.priority, priority)
+                self.coalesced += 1
+                return await asyncio.shield(pending.future)
+
+        # Общий лимит альбом расходует как несколько сообщений, лимит чата - как одно:
+        # иначе бакет чата с запасом chat_burst уходил бы в долг на весь альбом
+        cost = len(data.get('media') or ()) or 1
+        loop = asyncio.get_running_loop()
+        entry = _Outgoing(priority, next(self._seq), chat_id, cost, key, callback, args, kwargs,
+                          loop.create_future(), loop.time())
+        self._queue.append(entry)
+        if key is not None:
+            self._pending_edits[key] = entry
+        self._wakeup.set()
+        return await asyncio.shield(entry.future)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Забываем бакеты чатов без ожидающих запросов
+                waiting = {entry.chat_id for entry in self._queue}
+                self._chats = {chat: b for chat, b in self._chats.items() if chat in waiting}
+            # Отрицательные id - группы и каналы, у них лимит строже
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, capacity=self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _next_ready(self):
+        """(запрос, None), если есть готовый к отправке, иначе (None, сколько ждать)"""
+        now = asyncio.get_running_loop().time()
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        best, wait = None, None
+        for entry in self._queue:
+            if entry.future.done():
+                continue
+            delay = self._chat_bucket(entry.chat_id).delay()
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or (entry.priority, entry.seq) < (best.priority, best.seq):
+                best = entry
+        # Запросы, которые уже некому ждать, выкидываем
+        self._queue = [entry for entry in self._queue if not entry.future.done()]
+        self._depth_by_priority = self._count_by_priority()
+        return best, wait
+
+    def _count_by_priority(self) -> dict:
+        by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+        for entry in self._queue:
+            name = PRIORITY_NAMES.get(entry.priority, str(entry.priority))
+            by_priority[name] = by_priority.get(name, 0) + 1
+        return by_priority
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry, wait = self._next_ready()
+            if entry is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._global.acquire(min(entry.cost, self._global.capacity))
+            self._chat_bucket(entry.chat_id).consume()
+            self._queue.remove(entry)
+            if entry.key is not None and self._pending_edits.get(entry.key) is entry:
+                del self._pending_edits[entry.key]
+            if not entry.attempts:
+                self._waits.record(loop.time() - entry.enqueued_at)
+
+            task = asyncio.create_task(self._send(entry))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, entry: _Outgoing):
+        try:
+            result = await entry.callback(*entry.args, **entry.kwargs)
+        except RetryAfter as e:
+            self.retry_after += 1
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            loop = asyncio.get_running_loop()
+            self._paused_until = max(self._paused_until, loop.time() + retry_after)
+            entry.attempts += 1
+            logger.warning(f"⚠️ Telegram просит подождать {retry_after} с (попытка {entry.attempts})")
+            if entry.attempts > self.max_retries:
+                if not entry.future.done():
+                    entry.future.set_exception(e)
+                return
+            self._queue.append(entry)
+            self._wakeup.set()
+        except Exception as e:
+            if not entry.future.done():
+                entry.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not entry.future.done():
+                entry.future.set_result(result)
+
+    def stats(self) -> dict:
+        # Снимок заменяется целиком, а не изменяется, поэтому читать его безопасно из любого потока
+        by_priority = self._depth_by_priority
+        return {
+            'depth': sum(by_priority.values()),
+            'depth_by_priority': dict(by_priority),
+            'in_flight': len(self._in_flight),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retry_after': self.retry_after,
+            'wait_p50': self._waits.percentile(0.5),
+            'wait_p95': self._waits.percentile(0.95),
+        }
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+
+class RecordCache:
+    """Ограниченный LRU-кэш записей БД для горячих интерактивных запросов.
+
+    Чтобы чтение, начатое до записи, не положило в кэш устаревшее значение,
+    put принимает версию, снятую до запроса к базе: если с тех пор была
+    инвалидация, значение не сохраняется.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """(True, значение) при попадании, иначе (False, None)"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, version):
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys=(), predicate=None):
+        """Удаляет ключи keys и записи, для которых predicate(key, value) истинен"""
+        with self._lock:
+            self.version += 1
+            self.invalidations += 1
+            for key in keys:
+                self._entries.pop(key, None)
+            if predicate is not None:
+                for key in [k for k, v in self._entries.items() if predicate(k, v)]:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'size': size,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,108 @@
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def palette_similarity(a: bytes, b: bytes) -> float:
+    """Косинусная близость двух палитр"""
+    a = np.frombuffer(a, dtype=np.float32)
+    b = np.frombuffer(b, dtype=np.float32)
+    norm = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / norm) if norm else 0.0
+
+
+class ColorIndex:
+    """Матрица цветовых векторов всего каталога для поиска похожих букетов.
+
+    Строки нормированы по L2, поэтому косинусная близость ко всем букетам
+    считается одним умножением матрицы на вектор.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self._ids = np.empty(0, dtype=np.int64)
+        self._matrix = np.empty((0, dimensions), dtype=np.float32)
+        self._size = 0
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, bouquet_id) -> bool:
+        return bouquet_id in self._positions
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _grow(self, needed: int) -> None:
+        capacity = max(needed, 2 * len(self._ids), 1024)
+        ids = np.full(capacity, -1, dtype=np.int64)
+        matrix = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        ids[:self._size] = self._ids[:self._size]
+        matrix[:self._size] = self._matrix[:self._size]
+        self._ids, self._matrix = ids, matrix
+
+    def load(self, rows) -> None:
+        """rows - пары (bouquet_id, палитра-блоб) из базы"""
+        for bouquet_id, palette in rows:
+            self.add(bouquet_id, palette)
+        logger.info(f"✅ Цветовой индекс загружен: {len(self)} букетов")
+
+    def add(self, bouquet_id: int, palette: bytes) -> None:
+        vector = self._normalize(np.frombuffer(palette, dtype=np.float32))
+        with self._lock:
+            position = self._positions.get(bouquet_id)
+            if position is None:
+                if self._size >= len(self._ids):
+                    self._grow(self._size + 1)
+                position = self._size
+                self._size += 1
+                self._positions[bouquet_id] = position
+                self._ids[position] = bouquet_id
+            self._matrix[position] = vector
+
+    def discard(self, bouquet_id: int) -> None:
+        with self._lock:
+            position = self._positions.pop(bouquet_id, None)
+            if position is not None:
+                # Нулевая строка даёт нулевую близость, id -1 отфильтровывается
+                self._ids[position] = -1
+                self._matrix[position] = 0
+
+    def similarity(self, palette: bytes, bouquet_id: int):
+        """Близость палитры к букету из индекса или None, если его палитры нет"""
+        vector = self._normalize(np.frombuffer(palette, dtype=np.float32))
+        with self._lock:
+            position = self._positions.get(bouquet_id)
+            if position is None:
+                return None
+            return float(self._matrix[position] @ vector)
+
+    def similar(self, bouquet_id: int, limit: int = 5, min_score: float = 0.0) -> list:
+        """Список (bouquet_id, близость) самых похожих по цвету букетов.
+
+        Букеты с близостью не выше min_score не возвращаются: top-k по
+        каталогу без общих цветов иначе выдал бы просто случайные букеты.
+        """
+        with self._lock:
+            position = self._positions.get(bouquet_id)
+            if position is None:
+                return []
+            ids = self._ids[:self._size]
+            scores = self._matrix[:self._size] @ self._matrix[position]
+            scores[position] = -np.inf
+            scores[ids < 0] = -np.inf
+            scores[scores <= min_score] = -np.inf
+
+            count = min(limit, self._size - 1)
+            if count <= 0:
+                return []
+            top = np.argpartition(scores, -count)[-count:]
+            top = top[np.argsort(scores[top])[::-1]]
+            return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
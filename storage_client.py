@@ -1,30 +1,139 @@
+import asyncio
 import boto3
 import os
 import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from botocore.client import Config as BotoConfig
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from typing import Optional
-import uuid
 from dotenv import load_dotenv
 
+from metrics import Counter, Histogram
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+STORAGE_REQUEST_SECONDS = Histogram(
+    'storage_request_duration_seconds', 'Длительность запросов к Object Storage', ['operation']
+)
+STORAGE_REQUEST_ERRORS = Counter('storage_request_errors_total', 'Неудачные запросы к Object Storage', ['operation'])
+
+
+class _GrowingBody:
+    """Тело PUT для boto3, которое дописывается по мере скачивания.
+
+    Цикл событий добавляет чанки через feed(), а поток boto3 читает их
+    через read() и ждёт, пока не придут следующие. Уже полученные байты
+    сохраняются, поэтому seek(0) работает (повтор запроса, подсчёт хэша),
+    а после неудачи потокового PUT файл можно отправить из того же буфера.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._data = bytearray()
+        self._position = 0
+        self._finished = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    @property
+    def received(self) -> int:
+        return len(self._data)
+
+    def feed(self, chunk) -> None:
+        with self._condition:
+            self._data += chunk
+            self._condition.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._condition:
+            self._finished = True
+            self._error = error
+            self._condition.notify_all()
+
+    def getvalue(self) -> bytearray:
+        return self._data
+
+    def read(self, amount: int = -1) -> bytes:
+        with self._condition:
+            end = self.size if amount is None or amount < 0 else min(self.size, self._position + amount)
+            while len(self._data) < end and not self._finished:
+                self._condition.wait()
+            if self._error is not None:
+                raise IOError(f"скачивание прервано: {self._error}")
+            if len(self._data) < end:
+                # Иначе сервер ждал бы недостающие байты до таймаута
+                raise IOError(f"получено {len(self._data)} байт из {self.size}")
+            chunk = bytes(self._data[self._position:end])
+            self._position += len(chunk)
+            return chunk
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        base = {0: 0, 1: self._position, 2: self.size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
 class YandexStorageClient:
+    """Единый клиент Яндекс.Object Storage.
+
+    Один boto3-клиент (SigV4, общий пул соединений) создаётся при старте,
+    а блокирующие вызовы выполняются в собственном пуле потоков, так что
+    асинхронные методы никогда не блокируют event loop. Для тестов на
+    локальной S3-заглушке достаточно задать YC_STORAGE_ENDPOINT и
+    YC_STORAGE_ADDRESSING=path.
+    """
+
     def __init__(self):
         """Инициализация клиента для Яндекс.Object Storage"""
-        self.access_key = os.getenv("YC_ACCESS_KEY")
-        self.secret_key = os.getenv("YC_SECRET_KEY")
-        self.bucket_name = os.getenv("YC_BUCKET_NAME")
-        self.endpoint_url = "https://storage.yandexcloud.net"
-        
+        self.access_key = os.getenv("YC_ACCESS_KEY", "").strip()
+        self.secret_key = os.getenv("YC_SECRET_KEY", "").strip()
+        self.bucket_name = os.getenv("YC_BUCKET_NAME", "").strip()
+        self.endpoint_url = os.getenv("YC_STORAGE_ENDPOINT", "https://storage.yandexcloud.net")
+        self.region = os.getenv("YC_STORAGE_REGION", "ru-central1")
+        addressing_style = os.getenv("YC_STORAGE_ADDRESSING", "virtual")
+
         if not self.access_key or not self.secret_key or not self.bucket_name:
             raise ValueError("❌ Отсутствуют ключи доступа к Яндекс.Облаку")
-        
+
+        # Базовый адрес публичных ссылок
+        if addressing_style == "path":
+            default_public_url = f"{self.endpoint_url.rstrip('/')}/{self.bucket_name}"
+        else:
+            default_public_url = f"https://{self.bucket_name}.storage.yandexcloud.net"
+        self.public_url = os.getenv("YC_PUBLIC_URL", default_public_url).rstrip('/')
+
+        # Параллелизм по типам операций (put/get/delete/list)
+        max_connections = int(os.getenv("STORAGE_MAX_CONNECTIONS", "20"))
+        self._put_semaphore = asyncio.Semaphore(int(os.getenv("STORAGE_PUT_CONCURRENCY", "8")))
+        self._get_semaphore = asyncio.Semaphore(int(os.getenv("STORAGE_GET_CONCURRENCY", "8")))
+        self._delete_semaphore = asyncio.Semaphore(int(os.getenv("STORAGE_DELETE_CONCURRENCY", "4")))
+        self._list_semaphore = asyncio.Semaphore(int(os.getenv("STORAGE_LIST_CONCURRENCY", "2")))
+        # Серии метрик связываются один раз: тип операции однозначно задаётся семафором
+        self._metrics = {
+            semaphore: (STORAGE_REQUEST_SECONDS.labels(operation), STORAGE_REQUEST_ERRORS.labels(operation))
+            for semaphore, operation in (
+                (self._put_semaphore, 'put'),
+                (self._get_semaphore, 'get'),
+                (self._delete_semaphore, 'delete'),
+                (self._list_semaphore, 'list'),
+            )
+        }
+
+        # Multipart: размер части (минимум S3 - 5 МБ) и число частей в полёте
+        self.part_size = max(5 * 1024 * 1024, int(os.getenv("STORAGE_PART_SIZE", str(5 * 1024 * 1024))))
+        self.multipart_inflight = int(os.getenv("STORAGE_MULTIPART_INFLIGHT", "2"))
+
         logger.info(f"🔑 Access Key (первые 10 символов): {self.access_key[:10]}...")
-        logger.info(f"🔐 Secret Key (первые 5 символов): {self.secret_key[:5]}...")
         logger.info(f"📦 Bucket: {self.bucket_name}")
-        
+
         # ВАЖНО: правильная конфигурация для Яндекс.Облака
         self.s3 = boto3.client(
             's3',
@@ -33,68 +142,284 @@ class YandexStorageClient:
             aws_secret_access_key=self.secret_key,
             config=BotoConfig(
                 signature_version='s3v4',
-                region_name='ru-central1',
-                s3={'addressing_style': 'virtual'}  # важно для Яндекс.Облака
+                region_name=self.region,
+                s3={'addressing_style': addressing_style},
+                max_pool_connections=max_connections,
+                retries={'max_attempts': 3, 'mode': 'standard'}
             ),
-            region_name='ru-central1'
+            region_name=self.region
         )
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="storage")
         logger.info("✅ Storage клиент инициализирован")
-        
-        # Проверяем доступ к бакету
+
+    async def _run(self, semaphore, func, *args, **kwargs):
+        """Выполняет блокирующий вызов boto3 в пуле потоков"""
+        seconds, errors = self._metrics[semaphore]
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started)
+
+    async def check_access(self) -> bool:
+        """Проверяет доступ к бакету"""
         try:
-            self.s3.head_bucket(Bucket=self.bucket_name)
+            await self._run(self._list_semaphore, self.s3.head_bucket, Bucket=self.bucket_name)
             logger.info(f"✅ Доступ к бакету {self.bucket_name} подтвержден")
-        except ClientError as e:
+            return True
+        except (BotoCoreError, ClientError) as e:
             logger.error(f"❌ Ошибка доступа к бакету: {e}")
+            return False
 
-    def upload_file(self, file_bytes: bytes, file_name: str = None, content_type: str = 'image/jpeg') -> Optional[str]:
+    async def upload_file(self, file_bytes, file_name: str = None, content_type: str = 'image/jpeg') -> Optional[str]:
         """Загружает файл в Яндекс.Облако и возвращает публичную ссылку"""
         try:
             if file_name is None:
                 file_name = f"bouquets/{uuid.uuid4()}.jpg"
-            
-            logger.info(f"📤 Загружаю файл: {file_name}")
-            logger.info(f"📦 Размер файла: {len(file_bytes)} байт")
-            
+
+            logger.info(f"📤 Загружаю файл: {file_name} ({len(file_bytes)} байт)")
+
             # ВАЖНО: указываем ACL='public-read' для публичного доступа
-            self.s3.put_object(
+            await self._run(
+                self._put_semaphore,
+                self.s3.put_object,
                 Bucket=self.bucket_name,
                 Key=file_name,
                 Body=file_bytes,
                 ContentType=content_type,
                 ACL='public-read'  # это делает файл публичным
             )
-            
-            # Формируем публичную ссылку
-            url = f"https://{self.bucket_name}.storage.yandexcloud.net/{file_name}"
+
+            url = self.get_file_url(file_name)
             logger.info(f"✅ Файл успешно загружен: {url}")
             return url
-            
+
         except ClientError as e:
             error_code = e.response['Error']['Code']
             error_msg = e.response['Error']['Message']
             logger.error(f"❌ Ошибка загрузки {error_code}: {error_msg}")
-            
+
             if error_code == 'AccessDenied':
                 logger.error("🔑 AccessDenied - проверьте настройки бакета:")
-                logger.error("   1. В бакете cvetnik-photos → вкладка 'Доступ'")
+                logger.error("   1. В бакете → вкладка 'Доступ'")
                 logger.error("   2. Установите 'Чтение объектов' → 'Для всех' (публичный доступ)")
                 logger.error("   3. ИЛИ добавьте сервисный аккаунт с правами READ и WRITE")
             return None
+        except BotoCoreError as e:
+            logger.error(f"❌ Ошибка загрузки: {e}")
+            return None
+
+    async def upload_stream(self, chunks, file_name: str, content_type: str = 'image/jpeg',
+                            size: Optional[int] = None) -> Optional[str]:
+        """Загружает файл из асинхронного потока чанков без промежуточных копий.
+
+        Если размер известен заранее (size) и меньше part_size - а это почти
+        все фото из Telegram, - PUT начинается сразу и читает тело по мере
+        скачивания. Крупные файлы загружаются multipart-частями по part_size:
+        очередная часть отправляется, пока скачивается следующая, поэтому в
+        памяти не больше (multipart_inflight + 1) частей. В обоих случаях время
+        близко к max(скачивание, загрузка). Без size небольшой файл сначала
+        скачивается целиком и уходит одним PUT после этого.
+        """
+        if size is not None and 0 < size < self.part_size:
+            return await self._upload_growing(chunks, file_name, content_type, size)
+
+        upload_id = None
+        parts = []
+        in_flight = set()
+        try:
+            buffer = bytearray()
+            part_number = 0
+            async for chunk in chunks:
+                buffer += chunk
+                if len(buffer) < self.part_size:
+                    continue
+
+                if upload_id is None:
+                    response = await self._run(
+                        self._put_semaphore,
+                        self.s3.create_multipart_upload,
+                        Bucket=self.bucket_name,
+                        Key=file_name,
+                        ContentType=content_type,
+                        ACL='public-read'
+                    )
+                    upload_id = response['UploadId']
+                    logger.info(f"📤 Multipart-загрузка: {file_name}")
+
+                # Часть отдаётся целиком, новый буфер начинается с нуля
+                part_number += 1
+                in_flight.add(asyncio.ensure_future(
+                    self._upload_part(file_name, upload_id, part_number, buffer, parts)
+                ))
+                buffer = bytearray()
+                if len(in_flight) >= self.multipart_inflight:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+
+            if upload_id is None:
+                # Весь файл поместился в одну часть - обычный PUT
+                return await self.upload_file(buffer, file_name, content_type=content_type)
+
+            if buffer:
+                part_number += 1
+                in_flight.add(asyncio.ensure_future(
+                    self._upload_part(file_name, upload_id, part_number, buffer, parts)
+                ))
+            for task in asyncio.as_completed(in_flight):
+                await task
+            in_flight = set()
+
+            parts.sort(key=lambda part: part['PartNumber'])
+            await self._run(
+                self._put_semaphore,
+                self.s3.complete_multipart_upload,
+                Bucket=self.bucket_name,
+                Key=file_name,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+            url = self.get_file_url(file_name)
+            logger.info(f"✅ Файл успешно загружен ({part_number} частей): {url}")
+            return url
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка потоковой загрузки {file_name}: {e}")
+            for task in in_flight:
+                task.cancel()
+            if upload_id is not None:
+                try:
+                    await self._run(
+                        self._delete_semaphore,
+                        self.s3.abort_multipart_upload,
+                        Bucket=self.bucket_name,
+                        Key=file_name,
+                        UploadId=upload_id
+                    )
+                except (BotoCoreError, ClientError) as abort_error:
+                    logger.error(f"❌ Не удалось отменить multipart-загрузку: {abort_error}")
+            return None
+
+    async def _upload_growing(self, chunks, file_name, content_type, size) -> Optional[str]:
+        """Один PUT, который отправляет файл параллельно со скачиванием"""
+        body = _GrowingBody(size)
+        put = asyncio.ensure_future(self._run(
+            self._put_semaphore,
+            self.s3.put_object,
+            Bucket=self.bucket_name,
+            Key=file_name,
+            Body=body,
+            ContentLength=size,
+            ContentType=content_type,
+            ACL='public-read'
+        ))
+        try:
+            async for chunk in chunks:
+                body.feed(chunk)
+        except BaseException as e:
+            # Будим поток boto3, чтобы PUT завершился ошибкой, а не ждал данных вечно
+            body.finish(e)
+            await asyncio.gather(put, return_exceptions=True)
+            if isinstance(e, Exception):
+                logger.error(f"❌ Ошибка потоковой загрузки {file_name}: {e}")
+                return None
+            raise
+        body.finish()
+
+        try:
+            await put
+            if body.received == size:
+                url = self.get_file_url(file_name)
+                logger.info(f"✅ Файл успешно загружен: {url}")
+                return url
+            # Telegram сообщил неверный размер - объект в бакете неполный, перезаписываем
+            logger.warning(f"⚠️ {file_name}: получено {body.received} байт вместо {size}")
+        except Exception as e:
+            logger.warning(f"⚠️ Потоковый PUT {file_name} не удался ({e}), отправляю из буфера")
+        return await self.upload_file(body.getvalue(), file_name, content_type=content_type)
+
+    async def _upload_part(self, file_name, upload_id, part_number, body, parts):
+        response = await self._run(
+            self._put_semaphore,
+            self.s3.upload_part,
+            Bucket=self.bucket_name,
+            Key=file_name,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    async def download_file(self, file_name: str) -> Optional[bytes]:
+        """Скачивает объект целиком"""
+        def _get():
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=file_name)
+            return response['Body'].read()
+
+        try:
+            return await self._run(self._get_semaphore, _get)
+        except (BotoCoreError, ClientError) as e:
+            logger.error(f"❌ Ошибка скачивания {file_name}: {e}")
+            return None
 
-    def delete_file(self, file_name: str) -> bool:
+    async def delete_file(self, file_name: str) -> bool:
         """Удаляет файл из облака"""
         try:
-            self.s3.delete_object(
+            await self._run(
+                self._delete_semaphore,
+                self.s3.delete_object,
                 Bucket=self.bucket_name,
                 Key=file_name
             )
             logger.info(f"✅ Файл удалён: {file_name}")
             return True
-        except ClientError as e:
+        except (BotoCoreError, ClientError) as e:
             logger.error(f"❌ Ошибка удаления: {e}")
             return False
 
+    async def delete_objects(self, keys) -> int:
+        """Удаляет объекты пачками по 1000 ключей (лимит DeleteObjects); возвращает число удалённых"""
+        keys = list(keys)
+        deleted = 0
+        for start in range(0, len(keys), 1000):
+            chunk = keys[start:start + 1000]
+            try:
+                response = await self._run(
+                    self._delete_semaphore,
+                    self.s3.delete_objects,
+                    Bucket=self.bucket_name,
+                    Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+                )
+            except (BotoCoreError, ClientError) as e:
+                logger.error(f"❌ Ошибка пакетного удаления: {e}")
+                continue
+            # В режиме Quiet ответ содержит только ошибки
+            errors = response.get('Errors', [])
+            for error in errors[:5]:
+                logger.error(f"❌ Не удалён {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+            deleted += len(chunk) - len(errors)
+        logger.info(f"✅ Удалено объектов: {deleted} из {len(keys)}")
+        return deleted
+
+    async def list_objects_page(self, prefix: str = '', continuation_token: str = None, max_keys: int = 1000):
+        """Одна страница листинга: (список объектов, токен следующей страницы)"""
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix, 'MaxKeys': max_keys}
+        if continuation_token:
+            params['ContinuationToken'] = continuation_token
+        response = await self._run(self._list_semaphore, self.s3.list_objects_v2, **params)
+        next_token = response.get('NextContinuationToken') if response.get('IsTruncated') else None
+        return response.get('Contents', []), next_token
+
     def get_file_url(self, file_name: str) -> str:
         """Возвращает публичную ссылку на файл"""
-        return f"https://{self.bucket_name}.storage.yandexcloud.net/{file_name}"
+        return f"{self.public_url}/{file_name}"
+
+    def close(self):
+        """Останавливает пул потоков"""
+        self._executor.shutdown(wait=False)
@@ -1,80 +1,64 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
-import sqlite3
+import argparse
+import asyncio
 import logging
-import boto3
-from botocore.client import Config
 from dotenv import load_dotenv
 
+from bucket_sync import BucketReconcile, BucketSync
+from config import Config
+from database import Database
+from storage_client import YandexStorageClient
+
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Подключаемся к базе
-db_path = "content_bot.db"
-conn = sqlite3.connect(db_path)
-cursor = conn.cursor()
-
-# Создаем таблицу если её нет
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS bouquets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        file_id TEXT UNIQUE,
-        photo_url TEXT,
-        file_name TEXT,
-        name TEXT DEFAULT "Букет",
-        description TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-''')
 
-# Настройки Яндекс.Облака
-access_key = os.getenv("YC_ACCESS_KEY")
-secret_key = os.getenv("YC_SECRET_KEY")
-bucket_name = os.getenv("YC_BUCKET_NAME", "cvetnik-photos")
+async def show_progress(progress):
+    if progress['stage'] == 'listing':
+        logger.info(f"📄 Страниц: {progress['pages']}, просмотрено: {progress['scanned']}, новых: {progress['new']}")
+    elif progress['stage'] == 'writing':
+        logger.info(f"💾 Записано: {progress['added']} из {progress['total_new']}")
 
-# Подключаемся к S3
-s3 = boto3.client(
-    's3',
-    endpoint_url='https://storage.yandexcloud.net',
-    aws_access_key_id=access_key,
-    aws_secret_access_key=secret_key,
-    config=Config(signature_version='s3v4'),
-    region_name='ru-central1'
-)
 
-# Получаем список всех фото из папки bouquets/
-logger.info("📸 Сканируем облако...")
-response = s3.list_objects_v2(Bucket=bucket_name, Prefix='bouquets/')
+async def reconcile(db, storage, fix: bool):
+    logger.info("🔎 Сверяем облако с базой..." + (" (с исправлением)" if fix else ""))
+    results = await BucketReconcile(db, storage).run(fix=fix)
+    for result in results.values():
+        for key in result['samples_missing_rows']:
+            logger.info(f"❓ Объект без строки: {key}")
+        for file_name in result['samples_missing_objects']:
+            logger.info(f"🕳 Строка без объекта: {file_name}")
+    if not fix:
+        logger.info("Чтобы исправить расхождения, запустите с --reconcile --fix")
 
-if 'Contents' not in response:
-    logger.info("📭 В облаке нет фото")
-    exit()
 
-# Добавляем каждое фото в базу
-count = 0
-for obj in response['Contents']:
-    file_name = obj['Key']
-    photo_url = f"https://{bucket_name}.storage.yandexcloud.net/{file_name}"
-    
-    # Генерируем file_id из имени файла
-    file_id = file_name.replace('bouquets/', '').replace('.jpg', '')
-    
+async def main(args):
+    # Та же база (со всеми миграциями) и тот же клиент хранилища, что и в боте
+    db = Database()
+    storage = YandexStorageClient()
     try:
-        cursor.execute('''
-            INSERT OR IGNORE INTO bouquets (file_id, photo_url, file_name, name)
-            VALUES (?, ?, ?, ?)
-        ''', (file_id, photo_url, file_name, "Букет"))
-        
-        if cursor.rowcount > 0:
-            count += 1
-            logger.info(f"✅ Добавлено: {file_name}")
-            
-    except Exception as e:
-        logger.error(f"❌ Ошибка: {e}")
+        if args.reconcile:
+            await reconcile(db, storage, args.fix)
+            return
+        logger.info("📸 Сканируем облако...")
+        result = await BucketSync(
+            db, storage, prefix='bouquets/', batch_size=Config.SYNC_BATCH_SIZE,
+            lookback_seconds=Config.SYNC_LOOKBACK_SECONDS
+        ).run(on_progress=show_progress, full=args.full)
+        logger.info(f"🎉 Готово! Добавлено {result['added']} фото в базу, всего: {db.get_bouquets_count()}")
+        if result['variants_queued']:
+            logger.info(f"🖼 Задач на уменьшенные копии: {result['variants_queued']} (выполнит запущенный бот)")
+    finally:
+        storage.close()
+        db.close()
+
 
-conn.commit()
-logger.info(f"🎉 Готово! Добавлено {count} фото в базу")
-conn.close()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Синхронизация фото из Яндекс.Облака с базой бота")
+    parser.add_argument('--full', action='store_true', help="проверить все объекты, не только новые")
+    parser.add_argument('--reconcile', action='store_true', help="сверить облако с базой в обе стороны")
+    parser.add_argument('--fix', action='store_true', help="вместе с --reconcile: исправить расхождения")
+    asyncio.run(main(parser.parse_args()))
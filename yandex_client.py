@@ -1,109 +1,317 @@
-import requests
+import asyncio
+import json
+import httpx
 import logging
 import os
-import uuid
+import time
 from dotenv import load_dotenv
 
+from completion_cache import CompletionCache
+from concurrency import CircuitBreaker, LatencyTracker, backoff_delay
+from metrics import Counter, Histogram
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+GPT_REQUEST_SECONDS = Histogram(
+    'gpt_request_duration_seconds', 'Длительность запросов к YandexGPT (одна попытка)', ['mode']
+)
+GPT_REQUEST_ERRORS = Counter('gpt_request_errors_total', 'Неудачные запросы к YandexGPT', ['mode'])
+_COMPLETE_SECONDS = GPT_REQUEST_SECONDS.labels('complete')
+_COMPLETE_ERRORS = GPT_REQUEST_ERRORS.labels('complete')
+_STREAM_SECONDS = GPT_REQUEST_SECONDS.labels('stream')
+_STREAM_ERRORS = GPT_REQUEST_ERRORS.labels('stream')
+
 class YandexGPT:
-    """Класс для YandexGPT - оставляем как есть"""
+    """Клиент YandexGPT с общим пулом keep-alive соединений"""
+    
+    SYSTEM_PROMPT = "Ты - профессиональный флорист и копирайтер. Составляй красивые описания для букетов цветов."
     
     def __init__(self):
         self.folder_id = os.getenv("YANDEX_FOLDER") or os.getenv("YANDEX_FOLDER_ID")
         self.api_key = os.getenv("YANDEX_API_KEY")
         self.url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+        self.model = os.getenv("YANDEX_GPT_MODEL", "yandexgpt-lite")
+        self.temperature = 0.6
+        self.max_tokens = 200
         
-    def generate_description(self, prompt: str) -> str:
-        try:
-            headers = {
-                "Authorization": f"Api-Key {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "modelUri": f"gpt://{self.folder_id}/yandexgpt-lite",
-                "completionOptions": {
-                    "stream": False,
-                    "temperature": 0.6,
-                    "maxTokens": 200
+        # Таймауты и размер пула настраиваются через окружение
+        self.timeout = httpx.Timeout(
+            float(os.getenv("GPT_TIMEOUT", "30")),
+            connect=float(os.getenv("GPT_CONNECT_TIMEOUT", "5"))
+        )
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv("GPT_MAX_CONNECTIONS", "10")),
+            max_keepalive_connections=int(os.getenv("GPT_MAX_CONNECTIONS", "10")),
+            keepalive_expiry=60
+        )
+        self.max_concurrency = int(os.getenv("GPT_MAX_CONCURRENCY", "8"))
+        
+        self._client = None
+        self._semaphore = None
+        
+        # Кэш ответов; пустой GPT_CACHE_PATH отключает кэширование
+        cache_path = os.getenv("GPT_CACHE_PATH", "gpt_cache.db")
+        self.cache = CompletionCache(
+            cache_path,
+            ttl_seconds=int(os.getenv("GPT_CACHE_TTL", str(7 * 24 * 3600))),
+            max_entries=int(os.getenv("GPT_CACHE_MAX_ENTRIES", "5000"))
+        ) if cache_path else None
+        
+        # Повторы на 429/5xx, хеджирование по p95 и автоматический выключатель
+        self.max_retries = int(os.getenv("GPT_MAX_RETRIES", "3"))
+        self.retry_base_delay = float(os.getenv("GPT_RETRY_BASE_DELAY", "0.5"))
+        self.hedging = os.getenv("GPT_HEDGING", "0") not in ("0", "false", "False", "")
+        self.hedge_delay = float(os.getenv("GPT_HEDGE_DELAY", "3.0"))
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("GPT_BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("GPT_BREAKER_RESET", "30")),
+            name="YandexGPT"
+        )
+    
+    def _headers(self):
+        return {
+            "Authorization": f"Api-Key {self.api_key}",
+            "Content-Type": "application/json"
+        }
+    
+    def _build_payload(self, prompt: str, stream: bool = False) -> dict:
+        return {
+            "modelUri": f"gpt://{self.folder_id}/{self.model}",
+            "completionOptions": {
+                "stream": stream,
+                "temperature": self.temperature,
+                "maxTokens": self.max_tokens
+            },
+            "messages": [
+                {
+                    "role": "system",
+                    "text": self.SYSTEM_PROMPT
                 },
-                "messages": [
-                    {
-                        "role": "system",
-                        "text": "Ты - профессиональный флорист и копирайтер. Составляй красивые описания для букетов цветов."
-                    },
-                    {
-                        "role": "user",
-                        "text": prompt
-                    }
-                ]
-            }
-            
-            response = requests.post(self.url, headers=headers, json=data)
+                {
+                    "role": "user",
+                    "text": prompt
+                }
+            ]
+        }
+    
+    @staticmethod
+    def _parse_result(result: dict) -> str:
+        return result['result']['alternatives'][0]['message']['text']
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Общий асинхронный клиент создаётся один раз внутри event loop"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers=self._headers(),
+                timeout=self.timeout,
+                limits=self.limits
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+    
+    # Кэш - блокирующий sqlite3, поэтому обращения к нему идут в пуле потоков
+    
+    async def _cache_lookup(self, payload: dict, use_cache: bool):
+        """Возвращает (ключ, ответ из кэша или None)"""
+        if self.cache is None:
+            return None, None
+        key = self.cache.make_key(payload)
+        return key, (await asyncio.to_thread(self.cache.get, key) if use_cache else None)
+    
+    async def _cache_store(self, key, text: str, started: float):
+        if key is not None and text:
+            await asyncio.to_thread(self.cache.set, key, text, latency=time.monotonic() - started)
+    
+    RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+    
+    @classmethod
+    def _is_retryable(cls, error) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in cls.RETRYABLE_STATUSES
+        return isinstance(error, httpx.TransportError)
+    
+    async def _backoff_or_raise(self, error, attempt: int):
+        """Учитывает ошибку в автомате и ждёт перед повтором либо пробрасывает её"""
+        if not self._is_retryable(error):
+            # Сервис ответил - проблема в запросе, а не в его доступности
+            self.breaker.record_success()
+            raise error
+        self.breaker.record_failure()
+        if attempt >= self.max_retries:
+            raise error
+        
+        delay = None
+        if isinstance(error, httpx.HTTPStatusError):
+            try:
+                delay = float(error.response.headers.get("Retry-After", ""))
+            except ValueError:
+                pass
+        if delay is None:
+            delay = backoff_delay(attempt, self.retry_base_delay)
+        logger.warning(f"⚠️ GPT: попытка {attempt + 1} не удалась ({error}), повтор через {delay:.1f} с")
+        await asyncio.sleep(delay)
+    
+    async def _post_once(self, payload: dict) -> dict:
+        client = self._get_client()
+        started = time.monotonic()
+        try:
+            async with self._semaphore:
+                response = await client.post(self.url, json=payload)
             response.raise_for_status()
+        except Exception:
+            _COMPLETE_ERRORS.inc()
+            raise
+        elapsed = time.monotonic() - started
+        self.latency.record(elapsed)
+        _COMPLETE_SECONDS.observe(elapsed)
+        return response.json()
+    
+    async def _hedged_post(self, payload: dict) -> dict:
+        """Если ответа нет дольше p95, отправляет второй запрос и берёт первый ответ"""
+        if not self.hedging:
+            return await self._post_once(payload)
+        
+        p95 = self.latency.percentile(0.95) if len(self.latency) >= 20 else None
+        tasks = [asyncio.ensure_future(self._post_once(payload))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=p95 or self.hedge_delay)
+            if not done:
+                tasks.append(asyncio.ensure_future(self._post_once(payload)))
             
-            result = response.json()
-            return result['result']['alternatives'][0]['message']['text']
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def _complete(self, payload: dict) -> dict:
+        """Вызов API с повторами, хеджированием и автоматическим выключателем"""
+        attempt = 0
+        while True:
+            probe = self.breaker.check()
+            try:
+                result = await self._hedged_post(payload)
+            except Exception as e:
+                await self._backoff_or_raise(e, attempt)
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                # Отменённый пробный вызов не должен держать автомат полуоткрытым
+                self.breaker.release(probe)
+    
+    async def agenerate_description(self, prompt: str, use_cache: bool = True) -> str:
+        """Асинхронная генерация описания, не блокирует event loop.
+        
+        use_cache=False пропускает чтение из кэша, но обновляет запись.
+        """
+        try:
+            payload = self._build_payload(prompt)
+            key, cached = await self._cache_lookup(payload, use_cache)
+            if cached:
+                return cached
+            
+            started = time.monotonic()
+            text = self._parse_result(await self._complete(payload))
+            await self._cache_store(key, text, started)
+            return text
             
         except Exception as e:
             logger.error(f"Ошибка GPT: {e}")
             return ""
-
-
-class YandexStorage:
-    """Класс для Яндекс Облака - УПРОЩЕННЫЙ ДО ЖИЗНИ"""
     
-    def __init__(self):
-        self.access_key = os.getenv("YC_ACCESS_KEY", "").strip()
-        self.secret_key = os.getenv("YC_SECRET_KEY", "").strip()
-        self.bucket_name = os.getenv("YC_BUCKET_NAME", "").strip()
+    async def astream_description(self, prompt: str):
+        """Потоковая генерация: отдаёт накопленный текст по мере прихода чанков.
         
-        logger.info("=" * 50)
-        logger.info("STORAGE INIT")
-        logger.info(f"Access Key: {self.access_key[:10]}...")
-        logger.info(f"Bucket: {self.bucket_name}")
-        logger.info("=" * 50)
-
-    def upload_file(self, file_bytes, file_name=None):
-        """Загружает файл - МАКСИМАЛЬНО ПРОСТО"""
+        Повтор возможен только до первого чанка; хеджирование не применяется.
+        """
+        payload = self._build_payload(prompt, stream=True)
+        attempt = 0
+        while True:
+            probe = self.breaker.check()
+            streamed = False
+            started = time.monotonic()
+            try:
+                client = self._get_client()
+                async with self._semaphore:
+                    async with client.stream("POST", self.url, json=payload) as response:
+                        response.raise_for_status()
+                        # Каждая строка - отдельный JSON с полным текстом на текущий момент
+                        async for line in response.aiter_lines():
+                            if line.strip():
+                                streamed = True
+                                yield self._parse_result(json.loads(line))
+                self.breaker.record_success()
+                _STREAM_SECONDS.observe(time.monotonic() - started)
+                return
+            except Exception as e:
+                _STREAM_ERRORS.inc()
+                if streamed:
+                    self.breaker.record_failure()
+                    raise
+                await self._backoff_or_raise(e, attempt)
+                attempt += 1
+            finally:
+                self.breaker.release(probe)
+    
+    async def agenerate_streaming(self, prompt: str, on_progress=None, use_cache: bool = True) -> str:
+        """Потоковая генерация с колбэком on_progress(text) на каждый чанк.
+        
+        Возвращает итоговый текст или пустую строку при ошибке.
+        """
         try:
-            # Генерируем имя файла
-            if file_name is None:
-                file_name = f"bouquets/{uuid.uuid4().hex}.jpg"
-            
-            # Убираем лишнее
-            if file_name.startswith('/'):
-                file_name = file_name[1:]
-            
-            # Формируем URL
-            url = f"https://{self.bucket_name}.storage.yandexcloud.net/{file_name}"
+            key, cached = await self._cache_lookup(self._build_payload(prompt), use_cache)
+            if cached:
+                return cached
             
-            logger.info(f"📤 URL: {url}")
-            logger.info(f"📦 Size: {len(file_bytes)} bytes")
+            started = time.monotonic()
+            text = ""
+            async for text in self.astream_description(prompt):
+                if on_progress is not None:
+                    await on_progress(text)
+            await self._cache_store(key, text, started)
+            return text
             
-            # ПРОСТОЙ PUT запрос - без заморочек
-            response = requests.put(
-                url,
-                data=file_bytes,
-                headers={
-                    "Content-Type": "image/jpeg",
-                    "x-amz-acl": "public-read"
-                },
-                auth=(self.access_key, self.secret_key)
-            )
-            
-            logger.info(f"📊 Status: {response.status_code}")
-            
-            if response.status_code in [200, 201, 204]:
-                logger.info(f"✅ SUCCESS! File uploaded")
-                return url
-            else:
-                logger.error(f"❌ Failed: {response.status_code}")
-                logger.error(f"Response: {response.text[:200]}")
-                return None
-                
         except Exception as e:
-            logger.error(f"❌ ERROR: {e}")
-            return None
+            logger.error(f"Ошибка GPT (stream): {e}")
+            return ""
+    
+    def generate_description(self, prompt: str) -> str:
+        """Синхронная обёртка над agenerate_description для скриптов вне event loop.
+        
+        Повторы, автомат, кэш и метрики - те же, что у асинхронного пути.
+        """
+        async def run():
+            try:
+                return await self.agenerate_description(prompt)
+            finally:
+                # Клиент и семафор привязаны к циклу asyncio.run и закрываются вместе с ним
+                await self._close_client()
+        
+        return asyncio.run(run())
+    
+    def cache_stats(self) -> dict:
+        """Статистика кэша ответов (пустая, если кэш отключен)"""
+        return self.cache.stats() if self.cache is not None else {}
+    
+    async def _close_client(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._semaphore = None
+    
+    async def aclose(self):
+        """Закрывает пул соединений и кэш"""
+        await self._close_client()
+        if self.cache is not None:
+            self.cache.close()